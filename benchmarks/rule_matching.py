@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+"""
+Benchmark of matching channel messages against the @rule handlers of the loaded
+modules, comparing searching every rule of every callable (what the dispatcher used to
+do) against the prefiltered RuleMatcher built by the loader.
+
+Run from the root of the repository:
+
+    python benchmarks/rule_matching.py [number of messages]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from hermes.loader import build_dispatch_table, load_modules  # noqa: E402
+
+CHATTER = [
+    "anyone know if the new album is up yet?",
+    "lol",
+    "brb",
+    "the upload finished but my client still says 99%",
+    "thanks for the help earlier!",
+    "has anyone tried the new player update, it keeps crashing for me",
+    "good morning everyone",
+    "what's the best way to rip a vinyl properly?",
+    "i think the tracker was down for a minute there",
+    "yeah that happens sometimes",
+]
+
+COMMANDS = [
+    "!rules",
+    ".user someone",
+    "!quote",
+    "!help",
+    ".u",
+]
+
+LINKS = [
+    "check out https://orpheus.network/torrents.php?id=1234&torrentid=5678",
+    "https://orpheus.network/torrents.php?id=1234",
+    "https://orpheus.network/forums.php?action=viewthread&threadid=42 read this",
+    "https://orpheus.network/artist.php?id=99",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+]
+
+
+def make_traffic(count, seed=1):
+    """Roughly what a busy channel looks like: mostly chatter, some commands/links"""
+    rand = random.Random(seed)
+    traffic = []
+    for _ in range(count):
+        roll = rand.random()
+        if roll < 0.90:
+            traffic.append(rand.choice(CHATTER))
+        elif roll < 0.96:
+            traffic.append(rand.choice(COMMANDS))
+        else:
+            traffic.append(rand.choice(LINKS))
+    return traffic
+
+
+def search_all(entries, msg):
+    matches = []
+    for name, func, rule in entries:
+        match = rule.search(msg)
+        if match:
+            matches.append((name, func, match))
+    return matches
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    table = build_dispatch_table(load_modules())
+    matcher = table.rules['pubmsg']
+    traffic = make_traffic(count)
+
+    for msg in traffic[:1000]:
+        assert [m.group(0) for _, _, m in search_all(matcher.entries, msg)] == \
+            [m.group(0) for _, _, m in matcher.match(msg)]
+
+    naive = min(timeit.repeat(
+        lambda: [search_all(matcher.entries, msg) for msg in traffic],
+        number=1, repeat=5))
+    matched = min(timeit.repeat(
+        lambda: [matcher.match(msg) for msg in traffic], number=1, repeat=5))
+
+    print("{} pubmsg rules, {} messages".format(len(matcher.entries), count))
+    print("search every rule: {:8.1f} ns/message".format(naive / count * 1e9))
+    print("rule matcher:      {:8.1f} ns/message".format(matched / count * 1e9))
+    print("speedup:           {:8.2f}x".format(naive / matched))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,216 @@
 """
 API interface to Gazelle, operates through the api.php endpoint
 """
+import asyncio
 import logging
-from httpx import AsyncClient, codes, ReadTimeout
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+from httpx import (
+    AsyncClient, HTTPError, Limits, Timeout, TransportError, TimeoutException, codes
+)
 from urllib.parse import urljoin
 
-from .utils import convert
+from .ratelimit import TokenBucket
+from .records import project
+from .utils import view
 
 LOGGER = logging.getLogger('hermes')
 
+HIGH = 'high'
+LOW = 'low'
+
+# errors api.php answers with for ids and names that do not exist
+NOT_FOUND_ERRORS = (
+    'bad id', 'bad parameters', 'not found', 'no such', 'does not exist'
+)
+
+
+class _NotFound(object):
+    """
+    Cached in place of a response when the site said what was asked for does not
+    exist. It pickles by name, so that it is still the same object after the cache has
+    been saved and loaded again.
+    """
+    def __repr__(self):
+        return 'NOT_FOUND'
+
+    def __reduce__(self):
+        return 'NOT_FOUND'
+
+
+NOT_FOUND = _NotFound()
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to the site after a number of failures in a row, until reset seconds
+    have passed. A single call of high priority is then let through to find out if the
+    site is back, which closes the breaker again if it succeeds or keeps it open if it
+    does not (or never gets made).
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures=5, reset=30):
+        self.max_failures = failures
+        self.reset = reset
+        self.failures = 0
+        self.state = self.CLOSED
+        self.opened = None
+
+    def allow(self, priority=HIGH):
+        """
+        :param priority: priority of the call, only a HIGH call may be the probe
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and priority == HIGH and \
+                time.monotonic() - self.opened >= self.reset:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def abort(self):
+        """
+        The call let through was not made after all, so the breaker opens again for
+        another reset seconds
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened = time.monotonic()
+
+    def success(self):
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+            if self.state != self.OPEN:
+                LOGGER.warning('Gazelle API is unhealthy, failing fast for '
+                               f'{self.reset} seconds')
+            self.state = self.OPEN
+            self.opened = time.monotonic()
+
+
+class ApiLimiter(object):
+    """
+    Token bucket for the calls the bot makes to the site, which has its own limit on
+    the calls per API key. Calls of high priority (authenticating people) wait for a
+    token for as long as they need, those of low priority (previews) only take a token
+    when no high priority call is waiting and reserve tokens would be left over, and
+    are shed when they have not gotten one after defer seconds.
+    """
+    def __init__(self, rate=5, per=10, reserve=1, defer=5):
+        self.bucket = TokenBucket(rate / per, rate)
+        self.reserve = reserve
+        self.defer = defer
+        self.waiting = Counter()
+        self.shed = 0
+
+    async def acquire(self, lane):
+        """
+        :param lane: list holding the priority of the call, which may be raised by
+                     someone else while the call waits
+        :return: whether the call may be made, False if it was shed
+        """
+        deadline = time.monotonic() + self.defer
+        priority = lane[0]
+        self.waiting[priority] += 1
+        try:
+            while True:
+                if lane[0] != priority:
+                    self.waiting[priority] -= 1
+                    priority = lane[0]
+                    self.waiting[priority] += 1
+                if priority == HIGH:
+                    if self.bucket.consume():
+                        return True
+                    wait = self.bucket.wait_time()
+                else:
+                    needed = 1 + self.reserve
+                    if self.waiting[HIGH] == 0 and self.bucket.refill() >= needed:
+                        self.bucket.tokens -= 1
+                        return True
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        self.shed += 1
+                        LOGGER.debug('Shed low priority Gazelle API call')
+                        return False
+                    wait = min(wait, self.bucket.wait_time(needed))
+                await asyncio.sleep(max(wait, 0.01))
+        finally:
+            self.waiting[priority] -= 1
+
+    def metrics(self):
+        return {
+            'tokens': round(self.bucket.refill(), 2),
+            'capacity': self.bucket.capacity,
+            'waiting': {HIGH: self.waiting[HIGH], LOW: self.waiting[LOW]},
+            'shed': self.shed,
+        }
+
 
 class GazelleAPI(object):
-    def __init__(self, site_url, api_id, api_key, cache):
+    """
+    Responses are read through the region of the cache of the bot that their call
+    belongs in (see REGIONS), for as long as the TTL of the region, so that repeated
+    lookups of the same user or torrent skip the site. They are projected onto the
+    records of hermes.records, which keep only the fields the modules read.
+
+    The config is the api section of config.yml, which besides the credentials of the
+    bot may override the cache_ttl (in seconds) of each action, the client (pool size,
+    keepalive, timeouts and http2), the number of retries, the circuit breaker and the
+    rate limit of the API key (see ApiLimiter):
+
+        api:
+          client:
+            max_connections: 10
+            max_keepalive: 5
+            keepalive_expiry: 30
+            connect_timeout: 3
+            read_timeout: 5
+            http2: false
+          retries: 2
+          breaker:
+            failures: 5
+            reset: 30
+          rate_limit:
+            rate: 5
+            per: 10
+            reserve: 1
+            defer: 5
+    """
+    HIGH = HIGH
+    LOW = LOW
+    # cache region of the responses of each call, by the action and req parameters
+    REGIONS = {
+        ('user', None): 'users',
+        ('torrent', 'torrent'): 'torrents',
+        ('torrent', 'group'): 'groups',
+        ('forum', None): 'previews',
+        ('wiki', None): 'previews',
+        ('request', None): 'previews',
+        ('artist', None): 'previews',
+        ('collage', None): 'previews',
+    }
+    CLIENT = {
+        'max_connections': 10,
+        'max_keepalive': 5,
+        'keepalive_expiry': 30,
+        'connect_timeout': 3,
+        'read_timeout': 5,
+        'http2': False,
+    }
+    NEGATIVE_TTL = timedelta(minutes=2)
+    RETRIES = 2
+    BACKOFF = 0.25
+
+    def __init__(self, site_url, api_id, api_key, cache, config=None):
+        config = config or {}
         self.site_url = site_url
         self.api_id = api_id
         self.api_key = api_key
@@ -20,36 +219,163 @@ class GazelleAPI(object):
             'api.php?aid={}&token={}'.format(api_id, api_key)
         )
         self.cache = cache
-        self.client = AsyncClient()
+        self.ttls = {}
+        for action, seconds in (config.get('cache_ttl') or {}).items():
+            self.ttls[action] = timedelta(seconds=seconds)
+        negative_ttl = config.get('negative_ttl')
+        self.negative_ttl = self.NEGATIVE_TTL if negative_ttl is None \
+            else timedelta(seconds=negative_ttl)
+        self.client = _make_client(dict(self.CLIENT, **(config.get('client') or {})))
+        retries = config.get('retries')
+        self.retries = self.RETRIES if retries is None else retries
+        self.breaker = CircuitBreaker(**(config.get('breaker') or {}))
+        self.limiter = ApiLimiter(**(config.get('rate_limit') or {}))
+        # requests that are on their way to the site and their priority, by cache key
+        self.inflight = {}
 
-    async def _get(self, parameters):
+    async def _get(self, parameters, fresh=False, priority=LOW, timeout=None):
+        """
+        :param parameters: query parameters of the call to api.php
+        :param fresh: skip the cache and always ask the site, the response is still
+                      stored for whoever comes next
+        :param priority: HIGH for calls that someone is waiting on to be let in (or
+                         out), LOW for everything else
+        :param timeout: seconds to wait on the site overall (retries included), after
+                        which the caller gets what the cache had, or None. The request
+                        carries on for whoever comes next.
+        """
+        region, ttl = self._region(parameters)
+        key = _cache_key(parameters)
+        entry = self.cache.get_entry(key, region) if ttl is not None else None
+        if entry is not None and not fresh and not entry.expired():
+            return _response(entry.value)
+        if not self.breaker.allow(priority):
+            # fail fast while the site is down, with whatever we had of it before
+            return _response(entry.value) if entry is not None else None
         try:
-            r = await self.client.get(self.api_url, params=parameters)
-            if r.status_code == codes.OK:
-                response = r.json()
-                if response['status'] == 200:
-                    return convert(response['response'])
-            else:
+            return await asyncio.wait_for(
+                self._fetch_shared(key, parameters, ttl, priority, region), timeout)
+        except asyncio.TimeoutError:
+            LOGGER.warning(f'Gazelle API gave no answer within {timeout}s '
+                           f'for {parameters}')
+            return _response(entry.value) if entry is not None else None
+
+    def _region(self, parameters):
+        """
+        :return: the cache region and TTL of the call, where the TTL is None if its
+                 response is not to be cached
+        """
+        region = self.REGIONS.get((parameters['action'], parameters.get('req')))
+        if self.cache is None or region not in self.cache.regions:
+            return None, None
+        ttl = self.ttls.get(parameters['action'], self.cache.regions[region].ttl)
+        return region, ttl or None
+
+    def _fetch_shared(self, key, parameters, ttl, priority=LOW, region=None):
+        """
+        Has concurrent callers of the same call wait on a single request to the site,
+        which all get the same response (or None) from. The request is shielded, so that
+        one of the callers being cancelled does not take it down for the others, and
+        runs at the highest priority of its callers.
+        """
+        if key in self.inflight:
+            task, lane = self.inflight[key]
+            if priority == HIGH:
+                lane[0] = HIGH
+        else:
+            lane = [priority]
+            task = asyncio.ensure_future(
+                self._fetch(parameters, key, ttl, lane, region))
+            self.inflight[key] = (task, lane)
+
+            def done(_):
+                if self.inflight.get(key, (None,))[0] is task:
+                    del self.inflight[key]
+            task.add_done_callback(done)
+        return asyncio.shield(task)
+
+    async def _fetch(self, parameters, key=None, ttl=None, lane=None, region=None):
+        """
+        Calls the site, retrying with a jittered backoff on timeouts, network errors
+        and server errors. Only those count as failures for the circuit breaker, any
+        other response shows the site is up. Every attempt takes a token from the
+        limiter, and the call gives up with None if it gets shed.
+        """
+        if lane is None:
+            lane = [LOW]
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(random.uniform(0, self.BACKOFF * 2 ** attempt))
+            if not await self.limiter.acquire(lane):
+                self.breaker.abort()
+                return None
+            try:
+                r = await self.client.get(self.api_url, params=parameters)
+            except TimeoutException:
+                LOGGER.warning(f'Gazelle API timeout for {parameters}')
+                continue
+            except TransportError as e:
+                LOGGER.warning(f'Gazelle API network error for {parameters}: {e!r}')
+                continue
+            except HTTPError as e:
+                LOGGER.warning(f'Gazelle API error for {parameters}: {e!r}')
+                self.breaker.failure()
+                return None
+            except Exception as e:
+                LOGGER.warning(f'Gazelle API request failed for {parameters}')
+                LOGGER.exception(e)
+                self.breaker.failure()
+                return None
+            if r.status_code >= 500:
                 LOGGER.error(f'Gazelle API returned status code '
                              f'{r.status_code} for {parameters}')
-        except ReadTimeout:
-            LOGGER.warning(f'Gazelle API timeout for {parameters}')
-        except Exception as e:
-            LOGGER.warning('Gazelle API network error')
-            LOGGER.exception(e)
+                continue
+
+            self.breaker.success()
+            if r.status_code == codes.NOT_FOUND:
+                self._store_not_found(key, ttl, region)
+                return None
+            if r.status_code != codes.OK:
+                LOGGER.error(f'Gazelle API returned status code '
+                             f'{r.status_code} for {parameters}')
+                return None
+            try:
+                response = r.json()
+                if response['status'] == 200:
+                    response = project(parameters, view(response['response']))
+                    if ttl is not None:
+                        self.cache.store(key, response, ttl, region)
+                    return response
+                error = str(response.get('error', '')).lower()
+                if any(message in error for message in NOT_FOUND_ERRORS):
+                    self._store_not_found(key, ttl, region)
+            except Exception as e:
+                LOGGER.warning('Gazelle API returned an invalid response')
+                LOGGER.exception(e)
+            return None
+
+        self.breaker.failure()
         return None
 
-    async def get_user(self, user):
+    def _store_not_found(self, key, ttl, region=None):
+        """
+        Remembers that the site does not have what was asked for, for no longer than
+        the negative TTL. Only done for definitive answers, never for errors.
+        """
+        if ttl is not None and self.negative_ttl:
+            self.cache.store(key, NOT_FOUND, min(ttl, self.negative_ttl), region)
+
+    async def get_user(self, user, fresh=False, priority=LOW, timeout=None):
         if isinstance(user, int):
             return await self._get({
                 "action": "user",
                 "user_id": user
-            })
+            }, fresh, priority, timeout)
         else:
             return await self._get({
                 "action": "user",
                 "username": user
-            })
+            }, fresh, priority, timeout)
 
     async def get_topic(self, topic_id):
         return await self._get({
@@ -94,3 +420,45 @@ class GazelleAPI(object):
             "action": "collage",
             "collage_id": collage_id
         })
+
+    def metrics(self):
+        return {
+            'limiter': self.limiter.metrics(),
+            'breaker': self.breaker.state,
+            'inflight': len(self.inflight),
+        }
+
+
+def _response(value):
+    return None if value is NOT_FOUND else value
+
+
+def _cache_key(parameters):
+    """
+    Builds the cache key of a call, the same for any order or type of the parameters
+    (so that user_id=1 and user_id='1' share an entry). The key is in the api.<action>
+    namespace of the cache.
+    """
+    return 'api.{}_'.format(parameters['action']) + '&'.join(
+        '{}={}'.format(name, value)
+        for name, value in sorted(parameters.items())
+    )
+
+
+def _make_client(config):
+    http2 = config['http2']
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            LOGGER.warning('h2 is not installed, the Gazelle API will use HTTP/1.1')
+            http2 = False
+    return AsyncClient(
+        limits=Limits(
+            max_connections=config['max_connections'],
+            max_keepalive_connections=config['max_keepalive'],
+            keepalive_expiry=config['keepalive_expiry'],
+        ),
+        timeout=Timeout(config['read_timeout'], connect=config['connect_timeout']),
+        http2=http2,
+    )
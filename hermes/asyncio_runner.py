@@ -1,48 +1,205 @@
 """
-This whole thing is a hack to run commands asynchronously, stopping them
-from blocking the main thread (api requests!).
+Runs module commands asynchronously, stopping them from blocking the IRC
+reactor (api requests!).
 
-Ideally we switch over to irc.aio_client some time.
+With the select based reactor the commands are run on an event loop in a
+thread of their own (ModuleRunner). When the bot is run on the asyncio
+reactor, they are run directly on the loop of the reactor (LoopRunner).
 """
 
 import asyncio
+import functools
 import threading
 import logging
-import re
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import DotDict
 
 logger = logging.getLogger(__name__)
 
 
-class ModuleRunner(threading.Thread):
+class Job(object):
+    """A single call of a module function waiting to be run, or running, on the loop"""
+    __slots__ = ('name', 'func', 'connection', 'event', 'args', 'task', 'cancelled',
+                 'key')
+
+    def __init__(self, name, func, connection, event, args):
+        self.name = name
+        self.func = func
+        self.connection = connection
+        self.event = event
+        self.args = args
+        self.task = None
+        self.cancelled = False
+        self.key = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+
+
+class BaseRunner(object):
+    """
+    Calls of module functions are queued per module and started from those queues in a
+    weighted round robin, so that a burst of calls for one module (say, a pile of pasted
+    links) cannot crowd out the others. Each module may only have a limited number of
+    calls running at once, and when its queue overflows the oldest waiting call is
+    dropped. Functions marked with @priority() skip the queues and are started right
+    away.
+
+    All of the scheduling happens on the runner loop, so none of it needs locking.
+    """
     TIMEOUT = 120  # module call timeout in seconds
+    WORKERS = 4  # threads for running synchronous module functions
+    MAX_TASKS = 32  # calls running at once over all modules
+    CONCURRENCY = 4  # calls running at once per module
+    QUEUE_SIZE = 50  # calls waiting per module
+    WEIGHT = 1  # calls started per module per round
 
-    def __init__(self, bot, *a, **kw):
-        super().__init__(*a, **kw, daemon=True)
+    def __init__(self, bot):
         self.bot = bot
         self._loop = None
+        self._tasks = set()
+        self._latest = {}
+        self._queues = {}
+        self._ready = OrderedDict()
+        self._running = Counter()
+        self._active = 0
+        self.started = Counter()
+        self.dropped = Counter()
 
-    def run(self):
-        self._loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self._loop)
-        self._loop.run_forever()
+        config = bot.config.runner if 'runner' in bot.config else DotDict()
+        self.max_tasks = config.get('max_tasks', self.MAX_TASKS)
+        self.queue_size = config.get('queue_size', self.QUEUE_SIZE)
+        self.module_config = config.get('modules') or DotDict()
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.get('workers', self.WORKERS),
+            thread_name_prefix='hermes-module')
 
-    def stop(self):
-        if not self._loop:
-            return
-        self._loop.call_soon_threadsafe(self._loop.stop)
-        self._loop = None
+    def queue(self, connection, event, handlers):
+        """
+        Hands the callables that fire for an event over to the runner loop in one go.
 
-    def queue(self, name, func, connection, event):
-        if not self._loop:
-            return
-        asyncio.run_coroutine_threadsafe(
-            self._execute_module(name, func, connection, event), self._loop)
+        :param handlers: list of (module name, callable, args) tuples, where args are
+                         the extra arguments (the match object for rules) the callable
+                         takes
+        """
+        raise NotImplementedError
+
+    def spawn(self, func, *args):
+        """
+        Runs a coroutine function in the background on the runner loop, outside of the
+        scheduling of the module calls (and without their time limit).
+        """
+        raise NotImplementedError
+
+    def _spawn(self, func, args):
+        task = self._loop.create_task(func(*args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def metrics(self):
+        """
+        :return: dictionary of module name to the number of calls of it that are queued,
+                 running, have been started and have been dropped
+        """
+        names = set(self._queues) | set(self.started) | set(self.dropped)
+        return {name: {
+            'queued': len(self._queues.get(name, ())),
+            'running': self._running[name],
+            'started': self.started[name],
+            'dropped': self.dropped[name],
+        } for name in names}
+
+    def _module_setting(self, name, setting, default):
+        if name in self.module_config and setting in self.module_config[name]:
+            return self.module_config[name][setting]
+        return default
+
+    def _schedule(self, connection, event, handlers):
+        for name, func, args in handlers:
+            job = Job(name, func, connection, event, args)
+            if func.latest_wins is True:
+                self._supersede(job)
+            if func.priority is True:
+                self._start(job)
+                continue
+            if name not in self._queues:
+                self._queues[name] = deque()
+            queue = self._queues[name]
+            if len(queue) >= self.queue_size:
+                dropped = queue.popleft()
+                self._forget(dropped)
+                self.dropped[name] += 1
+                logger.warning(f"Dropped queued call: {name}.{dropped.func.__name__}"
+                               f" - queue full")
+            queue.append(job)
+            self._ready[name] = True
+            self._pump()
+
+    def _pump(self):
+        while self._active < self.max_tasks and len(self._ready) > 0:
+            started = False
+            for name in list(self._ready):
+                queue = self._queues[name]
+                limit = self._module_setting(name, 'concurrency', self.CONCURRENCY)
+                for _ in range(self._module_setting(name, 'weight', self.WEIGHT)):
+                    if len(queue) == 0 or self._running[name] >= limit or \
+                            self._active >= self.max_tasks:
+                        break
+                    job = queue.popleft()
+                    if job.cancelled:
+                        continue
+                    self._start(job)
+                    started = True
+                if len(queue) == 0:
+                    del self._ready[name]
+                else:
+                    self._ready.move_to_end(name)
+            if not started:
+                break
+
+    def _start(self, job):
+        self._running[job.name] += 1
+        self._active += 1
+        self.started[job.name] += 1
+        job.task = self._loop.create_task(self._execute_module(
+            job.name, job.func, job.connection, job.event, job.args))
+        # the loop only keeps weak references to its tasks
+        self._tasks.add(job.task)
+        job.task.add_done_callback(lambda task: self._finish(job))
+
+    def _finish(self, job):
+        self._tasks.discard(job.task)
+        self._forget(job)
+        self._running[job.name] -= 1
+        self._active -= 1
+        if self._loop is not None:
+            self._pump()
+
+    def _supersede(self, job):
+        event = job.event
+        target = event.source.nick if event.type == 'privmsg' else event.target
+        job.key = (job.name, job.func.__name__, target)
+        previous = self._latest.get(job.key)
+        if previous is not None:
+            logger.debug(f"Cancelling superseded call: {job.name}.{job.func.__name__}"
+                         f" ({target})")
+            previous.cancel()
+        self._latest[job.key] = job
+
+    def _forget(self, job):
+        if job.key is not None and self._latest.get(job.key) is job:
+            del self._latest[job.key]
 
-    async def _execute_module(self, name, func, connection, event):
+    async def _execute_module(self, name, func, connection, event, args):
+        timeout = func.time_limit if func.time_limit is not None else self.TIMEOUT
         # noinspection PyBroadException
         try:
             await asyncio.wait_for(
-                self._execute_function(func, connection, event), self.TIMEOUT)
+                self._execute_function(func, connection, event, *args), timeout)
         except asyncio.TimeoutError:
             logger.warning(f"Failed to run function: {name}.{func.__name__}"
                            f" - timeout")
@@ -53,19 +210,73 @@ class ModuleRunner(threading.Thread):
                 connection.privmsg(event.source.nick, msg)
             logger.exception(f"Failed to run function: {name}.{func.__name__}")
 
-    async def _execute_function(self, func, connection, event):
-        cmd = event.cmd
-        if hasattr(func, "commands"):
-            for command in func.commands:
-                if cmd == "." + command or cmd == "!" + command or \
-                        (event.type == "privmsg" and cmd == command):
-                    result = func(self.bot, connection, event)
-                    if asyncio.iscoroutine(result):
-                        await result
-        if hasattr(func, "rules"):
-            for rule in func.rules:
-                match = re.search(rule, event.msg)
-                if match:
-                    result = func(self.bot, connection, event, match)
-                    if asyncio.iscoroutine(result):
-                        await result
+    async def _execute_function(self, func, connection, event, *args):
+        # synchronous functions are run in the executor so that a slow one cannot hold
+        # up everything else on the loop, unless they've been marked as cheap enough to
+        # run inline
+        if asyncio.iscoroutinefunction(func) or func.inline is True:
+            result = func(self.bot, connection, event, *args)
+        else:
+            call = functools.partial(func, self.bot, connection, event, *args)
+            result = await self._loop.run_in_executor(self._executor, call)
+        if asyncio.iscoroutine(result):
+            await result
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class ModuleRunner(BaseRunner, threading.Thread):
+    def __init__(self, bot, *a, **kw):
+        threading.Thread.__init__(self, *a, **kw, daemon=True)
+        BaseRunner.__init__(self, bot)
+
+    def run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def stop(self):
+        if not self._loop:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+        self.shutdown()
+
+    def queue(self, connection, event, handlers):
+        if not self._loop or len(handlers) == 0:
+            return
+        self._loop.call_soon_threadsafe(self._schedule, connection, event, handlers)
+
+    def spawn(self, func, *args):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._spawn, func, args)
+
+
+class LoopRunner(BaseRunner):
+    """
+    Runs the module commands inline on the loop of the asyncio reactor, which is also
+    the thread that dispatches the events, so no handoff between threads is needed.
+    """
+    def __init__(self, bot, loop):
+        super().__init__(bot)
+        self.loop = loop
+
+    def is_alive(self):
+        return self._loop is not None
+
+    def start(self):
+        self._loop = self.loop
+
+    def stop(self):
+        self._loop = None
+        self.shutdown()
+
+    def queue(self, connection, event, handlers):
+        if not self._loop or len(handlers) == 0:
+            return
+        self._schedule(connection, event, handlers)
+
+    def spawn(self, func, *args):
+        if self._loop:
+            self._spawn(func, args)
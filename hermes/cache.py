@@ -2,34 +2,171 @@
 Ephemeral storage of arbitrary data.
 """
 
+import heapq
+import itertools
+import logging
+import pickle
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
 
-from .utils import DotDict
+LOGGER = logging.getLogger('hermes')
 
 
 class CacheObject(object):
-    def __init__(self, value, expiry):
+    """
+    Value in the cache, which expires at expiry on the monotonic clock. As that clock
+    does not survive a restart, the expiry is pickled as a wall clock timestamp.
+    """
+    __slots__ = ('value', 'expiry', 'size')
+
+    def __init__(self, value, expiry, size=0):
         self.value = value
         self.expiry = expiry
+        self.size = size
+
+    def expired(self, now=None):
+        return self.expiry <= (time.monotonic() if now is None else now)
+
+    def remaining(self):
+        """
+        :return: seconds until the value expires
+        """
+        return self.expiry - time.monotonic()
+
+    def __getstate__(self):
+        return self.value, time.time() + self.remaining(), self.size
+
+    def __setstate__(self, state):
+        # objects pickled before CacheObject had slots come with their __dict__
+        if isinstance(state, dict):
+            state = state['value'], state['expiry'], 0
+        value, expiry, size = state
+        # and before expiry was monotonic, it was a datetime
+        if isinstance(expiry, datetime):
+            expiry = _timestamp(expiry)
+        self.value = value
+        self.expiry = time.monotonic() + (expiry - time.time())
+        self.size = size
+
+
+DEFAULT = 'default'
+
+
+class Region(object):
+    """
+    Part of the cache with its own default TTL and size budget, whose entries are kept
+    in least to most recently used order. A region is cleared all at once by swapping
+    in a new dict and moving on to the next generation, which the leftovers of the old
+    generation (on the expiry heap) are told apart by.
+    """
+    def __init__(self, name, ttl, max_entries, max_bytes):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.generation = 0
 
 
 class Cache(object):
-    def __init__(self, storage=None, expiry=None):
-        if storage is not None:
-            self.storage = storage
-        else:
-            self.storage = DotDict()
+    """
+    Cache of values that expire, split into regions (users, torrents, groups, previews
+    and the default region for everything else). Every region is kept within its
+    max_entries and (approximately) max_bytes by evicting its least recently used
+    entries. The size of a value is taken as the size of it pickled, as that is what it
+    costs in the persistent storage.
+
+    Expiry times are kept in a min-heap next to the entries, so that expire() (which
+    the bot runs periodically) only has to look at the entries that are due. Entries
+    that were replaced, evicted or cleared are left in the heap and skipped over when
+    they come up, until they make up half of it and it is rebuilt.
+
+    Given a path, the cache is the first level in front of a DiskCache there: every
+    value stored is also written to disk, and a key that is not in memory (any longer)
+    is looked for on disk before it counts as a miss. Entries evicted from memory stay
+    on disk until they expire or their region is cleared. Iterating the cache, keys(),
+    items() and values() only cover what is in memory of the default region.
+
+    Hits, misses, expirations, evictions, entries and bytes are counted by region, and
+    within the default region by the namespace of the key, which is the part of it
+    before the first underscore (so user_itismadness counts for user). Loaded counts
+    the hits that were read from disk.
+    """
+    MAX_ENTRIES = 10000
+    MAX_BYTES = 16 * 1024 * 1024
+    # default settings of the regions, the ttl is in seconds
+    REGIONS = {
+        'users': {'ttl': 300},
+        'torrents': {'ttl': 21600},
+        'groups': {'ttl': 21600},
+        'previews': {'ttl': 3600},
+    }
+
+    def __init__(self, storage=None, expiry=None, max_entries=None, max_bytes=None,
+                 regions=None, path=None):
+        """
+        :param storage: the entries to start with, as dictionary of region name to
+                        entries (or the entries of the default region alone), which are
+                        copied into self.storage (the storage to persist)
+        :param expiry: default TTL of the default region
+        :param max_entries: default max_entries of every region
+        :param max_bytes: default max_bytes of every region
+        :param regions: settings (ttl, max_entries, max_bytes) of the regions, by name
+        :param path: path of the database of the DiskCache, if any, which the entries
+                     of storage are copied into as well
+        """
+        self.storage = {}
+        self.regions = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self.stats = {}
 
         if expiry is not None:
             self.expiry = expiry
         else:
             self.expiry = timedelta(7)
+        self.max_entries = max_entries if max_entries is not None \
+            else self.MAX_ENTRIES
+        self.max_bytes = max_bytes if max_bytes is not None else self.MAX_BYTES
+        self._lock = threading.RLock()
+        self.disk = DiskCache(path) if path else None
 
-    def __iter__(self):
-        return self.storage.__iter__()
+        self._add_region(DEFAULT, {})
+        regions = regions or {}
+        for name in set(self.REGIONS) | set(regions):
+            # settings that are not given for a region keep their defaults
+            self._add_region(name, dict(self.REGIONS.get(name, {}),
+                                        **(regions.get(name) or {})))
+
+        # whether the default region may still hold entries stored before there were
+        # regions, which are then looked for there when a region misses them
+        self.legacy = False
+        if storage is not None:
+            if any(isinstance(entry, CacheObject) for entry in storage.values()):
+                storage = {DEFAULT: storage}
+                self.legacy = True
+            for name, entries in storage.items():
+                region = self.regions.get(name) or self._add_region(name, {})
+                for key, entry in entries.items():
+                    if not entry.expired():
+                        if not entry.size:
+                            entry.size = _sizeof(entry.value)
+                        self._add(region, key, entry)
+                        if self.disk is not None:
+                            self.disk.put(region.name, key, region.generation, entry)
+                self._evict(region)
+        if self.disk is not None and not self.legacy:
+            self.legacy = self.disk.has_entries(DEFAULT,
+                                                self.regions[DEFAULT].generation)
 
-    def __next__(self):
-        return self.storage.__next__()
+    def __iter__(self):
+        return iter(self.keys())
 
     def __getitem__(self, key):
         return self.get(key)
@@ -38,43 +175,451 @@ class Cache(object):
         self.store(key, value)
 
     def __len__(self):
-        return len(self.storage)
+        """
+        :return: the number of entries in all regions
+        """
+        return sum(len(region.entries) for region in self.regions.values())
 
     def __contains__(self, key):
-        return key in self.storage
+        return key in self.regions[DEFAULT].entries
+
+    @property
+    def bytes(self):
+        return sum(region.bytes for region in self.regions.values())
 
     def keys(self):
-        return self.storage.keys()
+        return list(self.regions[DEFAULT].entries.keys())
 
     def items(self):
-        return self.storage.items()
+        return list(self.regions[DEFAULT].entries.items())
 
     def values(self):
-        return self.storage.values()
+        return list(self.regions[DEFAULT].entries.values())
 
-    def store(self, key, value, expiry=None):
+    def store(self, key, value, expiry=None, region=None):
+        """
+        :param expiry: TTL of the value, the TTL of the region if not given
+        :param region: name of the region to store the value in, default if not given
+        """
+        region = self.regions[region or DEFAULT]
         if not expiry:
-            expiry = self.expiry
-        self.storage[key] = CacheObject(value, datetime.now() + expiry)
+            expiry = region.ttl
+        if isinstance(expiry, timedelta):
+            expiry = expiry.total_seconds()
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            data = None
+        size = len(data) if data is not None else sys.getsizeof(value)
+        entry = CacheObject(value, time.monotonic() + expiry, size)
+        with self._lock:
+            self._remove(region, key)
+            self._add(region, key, entry)
+            self._evict(region)
+            if self.disk is not None and data is not None:
+                self.disk.put(region.name, key, region.generation, entry, data)
 
-    def get(self, key):
-        if key in self.storage:
-            if self.storage[key].expiry > datetime.now():
-                return self.storage[key].value
-            else:
-                del self.storage[key]
+    def get(self, key, region=None):
+        region = self.regions[region or DEFAULT]
+        with self._lock:
+            entry = self._lookup(region, key)
+            if entry is None:
+                self._count(region, key, 'misses')
+                return None
+            if entry.expired():
+                self._remove(region, key)
+                self._count(region, key, 'misses')
+                self._count(region, key, 'expired')
+                return None
+            region.entries.move_to_end(key)
+            self._count(region, key, 'hits')
+            return entry.value
 
-        return None
+    def get_entry(self, key, region=None):
+        """
+        :return: the CacheObject stored under the key, even if it has expired (which
+                 counts as a miss)
+        """
+        region = self.regions[region or DEFAULT]
+        with self._lock:
+            entry = self._lookup(region, key)
+            if entry is None or entry.expired():
+                self._count(region, key, 'misses')
+            else:
+                self._count(region, key, 'hits')
+            if entry is not None:
+                region.entries.move_to_end(key)
+            return entry
 
-    def clear(self, key=None):
+    def clear(self, key=None, region=None):
+        """
+        Clears the key from the region, or the whole region if no key is given, or the
+        whole cache if neither is.
+        """
         if key:
-            if key in self.storage:
-                del self.storage[key]
+            region = self.regions[region or DEFAULT]
+            with self._lock:
+                self._remove(region, key)
+                if self.disk is not None:
+                    self.disk.delete(region.name, key, region.generation)
+        elif region:
+            self.clear_region(region)
         else:
-            self.storage.clear()
+            for name in list(self.regions):
+                self.clear_region(name)
+            with self._lock:
+                self._heap = []
+
+    def clear_region(self, name):
+        """
+        Drops every entry of the region in constant time, by starting a new generation
+        of it in a fresh dict.
+        """
+        region = self.regions[name]
+        with self._lock:
+            old = region.entries
+            region.entries = self.storage[name] = OrderedDict()
+            region.bytes = 0
+            region.generation += 1
+            if self.disk is not None:
+                self.disk.clear(name, region.generation)
+            for namespace, stats in self.stats.items():
+                if namespace == name or \
+                        (name == DEFAULT and namespace not in self.regions):
+                    stats['entries'] = stats['bytes'] = 0
+        # the old entries are let go of outside the lock
+        del old
+
+    def expire(self):
+        """
+        Removes the entries that are past their expiry
+
+        :return: the number of entries removed
+        """
+        now = time.monotonic()
+        expired = 0
+        with self._lock:
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                expiry, _, name, generation, key = heapq.heappop(self._heap)
+                region = self.regions[name]
+                if region.generation != generation:
+                    continue
+                entry = region.entries.get(key)
+                if entry is not None and entry.expiry == expiry:
+                    self._remove(region, key)
+                    self._count(region, key, 'expired')
+                    expired += 1
+        if self.disk is not None:
+            self.disk.expire()
+        return expired
+
+    def metrics(self):
+        """
+        :return: dictionary of region (or namespace) to its entries, bytes, hits,
+                 misses, expired and evicted entries, with the totals under '*'
+        """
+        with self._lock:
+            metrics = {name: dict(stats) for name, stats in self.stats.items()}
+        total = Counter(dict.fromkeys(STATS, 0))
+        for stats in metrics.values():
+            total.update(stats)
+        metrics['*'] = dict(total)
+        return metrics
+
+    def close(self):
+        """
+        Writes out what is left to write to disk, and closes the DiskCache
+        """
+        if self.disk is not None:
+            self.disk.close()
+
+    def _lookup(self, region, key):
+        entry = self._find(region, key)
+        if entry is None and self.legacy and region.name != DEFAULT:
+            # moves the entry over from where it was stored before there were regions
+            default = self.regions[DEFAULT]
+            entry = self._find(default, key)
+            if entry is not None:
+                self._remove(default, key)
+                self._add(region, key, entry)
+                self._evict(region)
+                if self.disk is not None:
+                    self.disk.delete(DEFAULT, key, default.generation)
+                    self.disk.put(region.name, key, region.generation, entry)
+        return entry
+
+    def _find(self, region, key):
+        entry = region.entries.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(region.name, key, region.generation)
+            if entry is not None:
+                self._add(region, key, entry)
+                self._evict(region)
+                if not entry.expired():
+                    self._count(region, key, 'loaded')
+        return entry
+
+    def _add_region(self, name, config):
+        ttl = config.get('ttl')
+        region = self.regions[name] = Region(
+            name,
+            timedelta(seconds=ttl) if ttl is not None else self.expiry,
+            config.get('max_entries', self.max_entries),
+            config.get('max_bytes', self.max_bytes),
+        )
+        self.storage[name] = region.entries
+        if self.disk is not None:
+            region.generation = self.disk.generations.get(name, 0)
+        return region
+
+    def _count(self, region, key, stat, amount=1):
+        namespace = region.name if region.name != DEFAULT else _namespace(key)
+        if namespace not in self.stats:
+            self.stats[namespace] = Counter(dict.fromkeys(STATS, 0))
+        self.stats[namespace][stat] += amount
+
+    def _add(self, region, key, entry):
+        region.entries[key] = entry
+        region.bytes += entry.size
+        self._count(region, key, 'entries')
+        self._count(region, key, 'bytes', entry.size)
+        heapq.heappush(self._heap, (entry.expiry, next(self._counter), region.name,
+                                    region.generation, key))
+        if len(self._heap) > 2 * len(self) + 64:
+            self._heap = [
+                (entry.expiry, next(self._counter), region.name, region.generation, key)
+                for region in self.regions.values()
+                for key, entry in region.entries.items()
+            ]
+            heapq.heapify(self._heap)
+
+    def _remove(self, region, key):
+        entry = region.entries.pop(key, None)
+        if entry is not None:
+            region.bytes -= entry.size
+            self._count(region, key, 'entries', -1)
+            self._count(region, key, 'bytes', -entry.size)
+        return entry
+
+    def _evict(self, region):
+        while len(region.entries) > 0 and (len(region.entries) > region.max_entries or
+                                           region.bytes > region.max_bytes):
+            key = next(iter(region.entries))
+            self._remove(region, key)
+            self._count(region, key, 'evicted')
+
+
+class DiskCache(object):
+    """
+    Second level of the cache, in an SQLite database next to persist.dat, so that the
+    cache survives restarts without having to be pickled whole with the persistent
+    storage.
+
+    Writes are queued and done in batches by a writer thread, so that storing a value
+    never waits on the disk. Until a write is done, reads of its key are answered from
+    the pending writes. Every row carries the generation of its region, and only rows
+    of the current generation of a region are read, so a region is cleared as soon as
+    its generation is moved on, while the rows of older generations are deleted by the
+    writer afterwards.
+    """
+    # most writes done in a single transaction
+    BATCH = 500
+
+    def __init__(self, path):
+        self.path = path
+        # latest write of each (region, key) that is not done yet, as its sequence
+        # number, generation and entry (None for deletes)
+        self.pending = {}
+        self.written = 0
+        self.errors = 0
+        self.queue = queue.Queue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._reader = self._connect()
+        self.generations = dict(
+            self._reader.execute('SELECT name, generation FROM regions'))
+        self._writer = threading.Thread(target=self._write, name='DiskCache',
+                                        daemon=True)
+        self._writer.start()
+
+    def get(self, region, key, generation):
+        """
+        :return: the CacheObject stored under the key in the generation of the region,
+                 even if it has expired, None if there is none
+        """
+        with self._lock:
+            pending = self.pending.get((region, key))
+        if pending is not None:
+            _, pending_generation, entry = pending
+            return entry if pending_generation == generation else None
+        with self._read_lock:
+            row = self._reader.execute(
+                'SELECT value, expiry FROM entries '
+                'WHERE region = ? AND key = ? AND generation = ?',
+                (region, key, generation)
+            ).fetchone()
+        if row is None:
+            return None
+        data, expiry = row
+        try:
+            value = pickle.loads(data)
+        except Exception:
+            LOGGER.exception('Could not load {} from the disk cache'.format(key))
+            return None
+        return CacheObject(value, time.monotonic() + (expiry - time.time()), len(data))
+
+    def has_entries(self, region, generation):
+        """
+        :return: whether there are rows of the generation of the region
+        """
+        with self._read_lock:
+            return self._reader.execute(
+                'SELECT 1 FROM entries WHERE region = ? AND generation = ? LIMIT 1',
+                (region, generation)
+            ).fetchone() is not None
+
+    def put(self, region, key, generation, entry, data=None):
+        """
+        :param data: the value of the entry pickled, if it already is
+        """
+        if data is None:
+            try:
+                data = pickle.dumps(entry.value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                return
+        expiry = time.time() + entry.remaining()
+        self._queue('put', region, key, generation, entry, (expiry, data))
+
+    def delete(self, region, key, generation):
+        self._queue('delete', region, key, generation, None)
+
+    def clear(self, region, generation):
+        """
+        Moves the region on to the generation, which hides its rows of the older ones
+        """
+        self.generations[region] = generation
+        self.queue.put(('clear', region, generation))
 
     def expire(self):
-        keys = [k for k in iter(self.storage)]
-        for key in keys:
-            if self.storage[key].expiry < datetime.now():
-                del self.storage[key]
+        self.queue.put(('expire', time.time()))
+
+    def close(self):
+        self.queue.put(None)
+        self._writer.join()
+        with self._read_lock:
+            self._reader.close()
+
+    def metrics(self):
+        """
+        :return: dictionary of the number of writes that are queued, done and failed
+        """
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'errors': self.errors,
+        }
+
+    def _queue(self, op, region, key, generation, entry, row=None):
+        with self._lock:
+            sequence = next(self._sequence)
+            self.pending[(region, key)] = (sequence, generation, entry)
+        self.queue.put((op, region, key, generation, sequence, row))
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            connection.executescript(SCHEMA)
+        return connection
+
+    def _write(self):
+        connection = self._connect()
+        running = True
+        while running:
+            ops = [self.queue.get()]
+            while len(ops) < self.BATCH:
+                try:
+                    ops.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in ops:
+                running = False
+                ops = ops[:ops.index(None)]
+            try:
+                with connection:
+                    for op in ops:
+                        self._execute(connection, op)
+                self.written += len(ops)
+            except sqlite3.Error:
+                LOGGER.exception('Could not write to the disk cache')
+                self.errors += len(ops)
+            with self._lock:
+                for op in ops:
+                    if op[0] in ('put', 'delete'):
+                        key = (op[1], op[2])
+                        if self.pending.get(key, (None,))[0] == op[4]:
+                            del self.pending[key]
+        connection.close()
+
+    @staticmethod
+    def _execute(connection, op):
+        if op[0] == 'put':
+            _, region, key, generation, _, (expiry, data) = op
+            connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                (region, key, generation, expiry, data)
+            )
+        elif op[0] == 'delete':
+            connection.execute('DELETE FROM entries WHERE region = ? AND key = ?',
+                               (op[1], op[2]))
+        elif op[0] == 'clear':
+            _, region, generation = op
+            connection.execute('INSERT OR REPLACE INTO regions VALUES (?, ?)',
+                               (region, generation))
+            connection.execute(
+                'DELETE FROM entries WHERE region = ? AND generation < ?',
+                (region, generation)
+            )
+        elif op[0] == 'expire':
+            connection.execute('DELETE FROM entries WHERE expiry <= ?', (op[1],))
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    region TEXT NOT NULL,
+    key TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    expiry REAL NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (region, key)
+);
+CREATE INDEX IF NOT EXISTS entries_expiry ON entries (expiry);
+CREATE TABLE IF NOT EXISTS regions (
+    name TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+"""
+
+
+STATS = ('entries', 'bytes', 'hits', 'misses', 'expired', 'evicted', 'loaded')
+
+
+def _namespace(key):
+    return str(key).split('_', 1)[0]
+
+
+def _timestamp(when):
+    try:
+        return when.timestamp()
+    except (OverflowError, ValueError, OSError):
+        # datetime.min or datetime.max
+        return float('-inf') if when.year < 1970 else float('inf')
+
+
+def _sizeof(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
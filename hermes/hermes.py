@@ -6,6 +6,7 @@ also contains some utility functions that are used within the bot, those these
 functions may be moved elsewhere as appopriate.
 """
 import argparse
+import functools
 import locale
 import logging
 import os
@@ -15,18 +16,23 @@ import ssl
 import sys
 import threading
 import time
+from collections.abc import Mapping
+from datetime import timedelta
 import irc
 
-from irc.connection import Factory
+from irc.connection import AioFactory, Factory
 
 from .api import GazelleAPI
-from .asyncio_runner import ModuleRunner
+from .asyncio_runner import LoopRunner, ModuleRunner
 from .httpsocket import HttpThread
 from .irc import IRCBot
-from .loader import load_modules
-from .utils import get_git_hash, check_pid, load_config, DotDict
+from .loader import load_modules, build_dispatch_table
+from .utils import get_git_hash, check_pid, load_config
 from .cache import Cache
+from .identity import IdentityMap
 from .persist import PersistentStorage
+from .ratelimit import RateLimiter
+from .warmup import CacheWarmer
 
 locale.setlocale(locale.LC_ALL, 'en_US.utf8')
 __version__ = "0.2.0"
@@ -67,6 +73,7 @@ class Hermes(IRCBot):
 
         self.logger.info("-> Loading Modules")
         self.modules = load_modules()
+        self.dispatch_table = build_dispatch_table(self.modules)
         self.logger.info("-> Modules Loaded")
 
         if 'persist' in self.config and 'path' in self.config.persist:
@@ -74,16 +81,38 @@ class Hermes(IRCBot):
         else:
             persist_path = os.path.join(self.dir, 'persist.dat')
 
-        self.storage = PersistentStorage(persist_path)
+        self.storage = PersistentStorage(
+            persist_path,
+            self.config.persist.journal_max_bytes if 'persist' in self.config else None
+        )
 
         self.logger.info("-> Loaded Storage ({0} keys)".format(len(self.storage)))
-        if 'cache' not in self.storage:
-            self.storage['cache'] = DotDict()
-
-        self.cache = Cache(self.storage['cache'])
+        cache_config = self.config.get('cache') or {}
+        cache_path = cache_config.get('path', os.path.join(self.dir, 'cache.db'))
+        if cache_path:
+            cache_path = cache_path.replace('!HERMES!', self.dir)
+        self.cache = Cache(
+            self.storage['cache'] if 'cache' in self.storage else None,
+            max_entries=cache_config.get('max_entries'),
+            max_bytes=cache_config.get('max_bytes'),
+            regions=cache_config.get('regions'),
+            path=cache_path
+        )
+        if not cache_path:
+            self.storage.store('cache', self.cache.storage, journaled=False)
+        elif 'cache' in self.storage:
+            # the cache was moved over to its own database
+            self.storage.clear('cache')
+            self.storage.save()
 
         self.logger.info("-> Loaded Cache ({0} keys)".format(len(self.cache)))
 
+        self.rate_limiter = RateLimiter(self.config.get('rate_limit'))
+        self.identities = IdentityMap()
+        self.warmer = None
+        if 'warmup' in self.config and self.config.warmup.enabled is True:
+            self.warmer = CacheWarmer(self, self.config.warmup)
+
         self.http_listener = None
         if 'http_socket' in self.config:
             self.http_listener = HttpThread(self.config['http_socket'])
@@ -92,7 +121,8 @@ class Hermes(IRCBot):
             self.config.site.url,
             self.config.api.id,
             self.config.api.key,
-            self.cache
+            self.cache,
+            self.config.api
         )
 
         for name, mod in self.modules.items():
@@ -104,18 +134,37 @@ class Hermes(IRCBot):
             except BaseException:
                 self.logger.exception("Error Module: {}".format(name))
 
-        if 'ssl' in self.config.irc and self.config.irc.ssl is True:
+        use_asyncio = 'asyncio' in self.config.irc and self.config.irc.asyncio is True
+        use_ssl = 'ssl' in self.config.irc and self.config.irc.ssl is True
+        # like the select based connection always did, the certificate of the server
+        # is only verified if asked for
+        ssl_verify = self.config.irc.ssl_verify is True
+        if use_asyncio:
+            factory = AioFactory(ssl=_ssl_context(ssl_verify)) if use_ssl \
+                else AioFactory()
+        elif use_ssl and ssl_verify:
+            factory = Factory(wrapper=functools.partial(
+                _ssl_context(True).wrap_socket, server_hostname=self.config.irc.host))
+        elif use_ssl:
             factory = Factory(wrapper=ssl.wrap_socket)
         else:
             factory = Factory()
 
-        self.module_runner = ModuleRunner(self)
-
         super().__init__([(self.config.irc.host, self.config.irc.port)],
                          '{}{}'.format(self.nick, random.randint(1, 1000)), self.name,
-                         connect_factory=factory)
+                         use_asyncio=use_asyncio, connect_factory=factory)
+
+        if use_asyncio:
+            self.module_runner = LoopRunner(self, self.reactor.loop)
+        else:
+            self.module_runner = ModuleRunner(self)
         for attr in ("on_pubmsg", "on_privmsg"):
             setattr(self, attr, self._dispatch)
+        # reaps the cache entries that are due, so it never has to be scanned whole
+        self.reactor.scheduler.execute_every(
+            timedelta(seconds=cache_config.get('sweep_interval', 60)),
+            self.cache.expire
+        )
         self.logger.info("-> Loaded IRC")
 
     def set_nick(self, connection):
@@ -177,13 +226,16 @@ class Hermes(IRCBot):
             if not self.http_listener.is_alive():
                 self.http_listener.start()
         if hasattr(self.config.irc, "channels") and \
-                isinstance(self.config.irc.channels, dict):
+                isinstance(self.config.irc.channels, Mapping):
             for name in self.config.irc.channels:
                 self.logger.info("-> Entering {}".format(name))
                 connection.send_raw("SAJOIN {} #{}".format(self.nick, name))
+        if self.warmer is not None:
+            self.warmer.start(connection)
 
     def on_disconnect(self, connection, event):
         self.logger.info("-> Disconnected from IRC")
+        self.identities.clear()
 
     def check_admin(self, event):
         return event.source.nick in self.config.admins \
@@ -191,6 +243,15 @@ class Hermes(IRCBot):
             and event.source.host.endswith(self.config.site.tld) \
             and event.source.host.split(",")[0] not in self.config.admins
 
+    def on_quit(self, connection, event):
+        self.identities.forget(event.source.nick, event.source.host)
+
+    def on_nick(self, connection, event):
+        self.identities.forget(event.source.nick, event.source.host)
+
+    def on_kill(self, connection, event):
+        self.identities.forget(event.target)
+
     def _dispatch(self, connection, event):
         """
         :param connection:
@@ -211,21 +272,62 @@ class Hermes(IRCBot):
             return
         event.cmd = args[0].lower()
         event.args = args[1:] if len(args) > 1 else []
-        for name, mod in self.modules.items():
-            for func in mod.__callables__:
-                if func.disabled is True:
-                    continue
-                elif func.admin_only is True and not self.check_admin(event):
-                    continue
-                elif event.type not in func.events:
-                    continue
-                self.module_runner.queue(name, func, connection, event)
+        table = self.dispatch_table
+        # (module name, callable, args)
+        handlers = []
+        # the message is rate limited once, by the command if it is one, otherwise by
+        # the first rule it matched
+        limit_name = None
+        for name, func in table.get_commands(event.type, event.cmd):
+            if func.admin_only is True and not self.check_admin(event):
+                continue
+            handlers.append((name, func, ()))
+            limit_name = event.cmd.lstrip('.!')
+        for name, func, match in table.match_rules(event.type, event.msg):
+            if func.admin_only is True and not self.check_admin(event):
+                continue
+            handlers.append((name, func, (match,)))
+            if limit_name is None:
+                limit_name = func.__name__
+        if len(handlers) == 0:
+            return
+
+        if not self.check_admin(event):
+            user = event.source.host or event.source.nick
+            channel = event.target if event.type == 'pubmsg' else None
+            if not self.rate_limiter.allow(limit_name, user, channel):
+                return
+        self.module_runner.queue(connection, event, handlers)
+
+    def rebuild_dispatch_table(self):
+        """
+        Rebuilds the dispatch table from the currently loaded modules, must be called
+        after any module is (re)loaded for its callables to be picked up.
+        """
+        self.dispatch_table = build_dispatch_table(self.modules)
+
+    def metrics(self):
+        """
+        :return: dictionary of the state of the module runner, the command rate limiter,
+                 the Gazelle API client and the cache (and its disk)
+        """
+        metrics = {
+            'runner': self.module_runner.metrics(),
+            'rate_limit': self.rate_limiter.metrics(),
+            'api': self.api.metrics(),
+            'cache': self.cache.metrics(),
+        }
+        if self.cache.disk is not None:
+            metrics['cache_disk'] = self.cache.disk.metrics()
+        return metrics
 
     def disconnect(self, msg="I'll be back!"):
         super(Hermes, self).disconnect(msg)
 
     def restart(self):
         self.disconnect()
+        self.cache.close()
+        self.storage.close()
         raise RestartException
 
 
@@ -260,18 +362,29 @@ class SaveData(threading.Thread):
         self.logger = LOGGER
 
     def run(self):
-        cycle = 480
+        # changes are journaled as they are made, this flushes the journal to disk
+        # every second and compacts it once it grows too large
         while self.alive:
-            if cycle >= 600:
-                self.logger.info('saving data')
-                self.bot.storage.save()
-                cycle = 0
-            cycle += 1
+            if self.bot.storage.sync():
+                self.logger.info('compacted the storage journal')
             time.sleep(1)
 
     def stop(self):
         self.alive = False
         self.join()
+        self.logger.info('saving data')
+        self.bot.storage.save(wait=True)
+
+
+def _ssl_context(verify):
+    """
+    :param verify: whether to verify the certificate and hostname of the server
+    """
+    context = ssl.create_default_context()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
 
 
 def get_version_string():
@@ -376,6 +489,7 @@ def run_hermes():
 
     last_run = None
     save_thread = None
+    hermes = None
     try:
         hermes = Hermes()
         save_thread = SaveData(hermes)
@@ -405,6 +519,7 @@ def run_hermes():
                 # thread.stop()
                 time.sleep(5)
                 hermes = Hermes()
+                save_thread.bot = hermes
                 # thread = BotCheck(hermes)
                 # thread.start()
                 hermes.start()
@@ -419,5 +534,7 @@ def run_hermes():
     finally:
         if save_thread is not None:
             save_thread.stop()
+        if hermes is not None:
+            hermes.cache.close()
         if os.path.isfile(pidfile):
             os.unlink(pidfile)
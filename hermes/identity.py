@@ -0,0 +1,138 @@
+"""
+Map of the vhosts the bot gave out with CHGHOST to who they belong to, so that checking
+whether someone may run a command does not have to ask the site every time.
+"""
+import threading
+import time
+
+from .records import Record
+
+
+class Identity(Record):
+    """What the permission checks need to know of a user"""
+    __slots__ = ('ID', 'Username', 'Class', 'SecondaryClasses', 'Level')
+
+
+class IdentityMap(object):
+    """
+    Identities by vhost, with an index of the nick that was given the vhost so the
+    entry can be dropped when that nick quits, changes nick or is killed. Entries also
+    expire after ttl seconds, as the bot does not see the quits of people that are not
+    in any of its channels.
+    """
+    TTL = 3600
+
+    def __init__(self, ttl=None):
+        self.ttl = self.TTL if ttl is None else ttl
+        self.identities = {}
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def add(self, host, user, nick=None):
+        """
+        :param host: vhost of the user
+        :param user: user record (or response) of the site
+        :param nick: nick the vhost was given to, if known
+        """
+        identity = Identity.project(user)
+        with self._lock:
+            self.identities[host.lower()] = (identity, time.monotonic() + self.ttl)
+            if nick is not None:
+                self.hosts[nick.lower()] = host.lower()
+        return identity
+
+    def get(self, host):
+        entry = self.identities.get(host.lower())
+        if entry is None:
+            return None
+        identity, expiry = entry
+        if expiry <= time.monotonic():
+            self.forget(host=host)
+            return None
+        return identity
+
+    def forget(self, nick=None, host=None):
+        with self._lock:
+            if nick is not None:
+                nick_host = self.hosts.pop(nick.lower(), None)
+                if nick_host is not None:
+                    self.identities.pop(nick_host, None)
+            if host is not None:
+                self.identities.pop(host.lower(), None)
+
+    def clear(self):
+        with self._lock:
+            self.identities.clear()
+            self.hosts.clear()
+
+    def __len__(self):
+        return len(self.identities)
+
+
+def make_vhost(bot, user):
+    """
+    :return: the vhost that enter gives the user, <username>.<class>.<site tld>
+    """
+    return "{}.{}.{}".format(
+        user.Username,
+        user.ClassName.replace(" ", ""),
+        bot.config.site.tld
+    )
+
+
+async def get_identity(bot, host, nick=None, priority=None):
+    """
+    Looks up who the vhost belongs to, in the identity map or if it is not in there on
+    the site (which then adds it to the map).
+
+    :param nick: nick the vhost is in use by, if known
+    :param priority: priority of the call to the site, HIGH by default
+    :return: Identity of the user, None if the host is not a vhost of the bot or the
+             user could not be found
+    """
+    split_host = host.split(".")
+    if len(split_host) != 4 or not host.endswith(bot.config.site.tld):
+        return None
+    identity = bot.identities.get(host)
+    if identity is not None:
+        return identity
+    if priority is None:
+        priority = bot.api.HIGH
+    user = await bot.api.get_user(split_host[0], priority=priority)
+    if user is None:
+        return None
+    return bot.identities.add(host, user, nick)
+
+
+def is_authorized(identity, min_level=None, class_id=None):
+    """
+    :return: whether the user is at least of the minimum level, or has the class as one
+             of their secondary classes
+    """
+    if class_id is not None and class_id in identity['SecondaryClasses']:
+        return True
+    return min_level is not None and identity['Level'] >= min_level
+
+
+async def authorize(bot, connection, host, nick, prompt, action, min_level=None,
+                    class_id=None):
+    """
+    Shared check of the check_auth helpers of the modules, whether the one issuing a
+    command is authorized to do so.
+
+    :param prompt: notice the nick why they are not authorized
+    :param action: what is being authorized, for the notice (e.g. 'administer quotes')
+    :return: whether they are authorized
+    """
+    identity = await get_identity(bot, host)
+    if identity is None:
+        if prompt:
+            connection.notice(nick, "You must be authed through the bot to {}.".format(
+                action))
+        return False
+
+    if is_authorized(identity, min_level, class_id):
+        return True
+    if prompt:
+        connection.notice(nick, "You are not authorized to do this command!")
+    return False
@@ -1,15 +1,18 @@
+import asyncio
 import threading
+import time
 import irc.bot
 import irc.client
+import irc.client_aio
+import irc.schedule
 from datetime import datetime, timedelta
 
 
-class ServerConnection(irc.client.ServerConnection):
+class ServerConnectionMixin(object):
     def __init__(self, reactor):
-        super(ServerConnection, self).__init__(reactor)
+        super(ServerConnectionMixin, self).__init__(reactor)
         self.last_ping = None
         self.last_pong = None
-        self._write_mutex = threading.Lock()
 
     def ping(self, target, target2=""):
         """Send a PING command."""
@@ -22,15 +25,86 @@ class ServerConnection(irc.client.ServerConnection):
         """Send a KILL command."""
         self.send_items('KILL', nick, comment and ':' + comment)
 
+
+class ServerConnection(ServerConnectionMixin, irc.client.ServerConnection):
+    def __init__(self, reactor):
+        super(ServerConnection, self).__init__(reactor)
+        self._write_mutex = threading.Lock()
+
     def send_raw(self, string):
         with self._write_mutex:
             super().send_raw(string)
 
 
+class AioServerConnection(ServerConnectionMixin, irc.client_aio.AioConnection):
+    def send_raw(self, string):
+        """
+        Writes to the transport of the connection, which may only be done from the
+        thread running the event loop. Anything else that wants to send (like the http
+        listener) gets its write handed over to the loop instead.
+        """
+        loop = self.reactor.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            super().send_raw(string)
+        else:
+            loop.call_soon_threadsafe(super().send_raw, string)
+
+
 class Reactor(irc.client.Reactor):
     connection_class = ServerConnection
 
 
+class LoopScheduler(irc.schedule.IScheduler):
+    """
+    Scheduler that runs its commands as timers on an asyncio loop, instead of having
+    them polled by the reactor.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+
+    def execute_every(self, period, func):
+        delay = _seconds(period)
+
+        def run():
+            self.loop.call_later(delay, run)
+            func()
+        self.loop.call_later(delay, run)
+
+    def execute_at(self, when, func):
+        if isinstance(when, datetime):
+            delay = (when - datetime.now(when.tzinfo)).total_seconds()
+        else:
+            delay = when - time.time()
+        self.loop.call_later(max(delay, 0), func)
+
+    def execute_after(self, delay, func):
+        self.loop.call_later(_seconds(delay), func)
+
+    def run_pending(self):
+        pass
+
+
+def _seconds(period):
+    if isinstance(period, timedelta):
+        return period.total_seconds()
+    return period
+
+
+class AioReactor(irc.client_aio.AioReactor):
+    connection_class = AioServerConnection
+
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        super(AioReactor, self).__init__(loop=loop)
+        self.scheduler = LoopScheduler(self.loop)
+
+
 class IRCBot(irc.bot.SingleServerIRCBot):
     reactor_class = Reactor
     timeout_interval = 40
@@ -43,11 +117,22 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         nickname,
         realname,
         recon=None,
+        use_asyncio=False,
         **connect_params
     ):
+        """
+        :param use_asyncio: run the bot on the asyncio based reactor of the irc library,
+                            where the connection and all scheduled jobs share one event
+                            loop, instead of the select based one
+        """
         if recon is None:
             recon = irc.bot.ExponentialBackoff(min_interval=10, max_interval=300)
 
+        self.use_asyncio = use_asyncio
+        if use_asyncio:
+            self.reactor_class = AioReactor
+        self._connect_task = None
+
         super(IRCBot, self).__init__(
             server_list,
             nickname,
@@ -65,6 +150,22 @@ class IRCBot(irc.bot.SingleServerIRCBot):
             self.check_keepalive
         )
 
+    def connect(self, *args, **kwargs):
+        if not self.use_asyncio:
+            return super(IRCBot, self).connect(*args, **kwargs)
+        self._connect_task = self.reactor.loop.create_task(
+            self._connect_aio(*args, **kwargs))
+
+    async def _connect_aio(self, *args, **kwargs):
+        try:
+            await self.connection.connect(*args, **kwargs)
+        except OSError:
+            # same as the select based bot does on a ServerConnectionError, so the
+            # reconnect strategy kicks in
+            self.connection._handle_event(
+                irc.client.Event("disconnect", self.connection.server, "", [""])
+            )
+
     def check_keepalive(self):
         if self.connection.last_pong is None or not self.connection.is_connected():
             return
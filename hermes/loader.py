@@ -11,6 +11,16 @@ import os
 import re
 import sys
 
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+COMMAND_PREFIXES = ('.', '!')
+# minimum length of a literal (or shared prefix of literals) worth prefiltering on
+MIN_LITERAL = 3
+MIN_GATE = 8
+
 
 def load_modules():
     """
@@ -54,6 +64,10 @@ def load_module(modules, module_path):
 def _parse_callable(obj):
     obj.admin_only = getattr(obj, "admin_only", False) is True
     obj.disabled = getattr(obj, 'disabled', False) is True
+    obj.inline = getattr(obj, 'inline', False) is True
+    obj.latest_wins = getattr(obj, 'latest_wins', False) is True
+    obj.priority = getattr(obj, 'priority', False) is True
+    obj.time_limit = getattr(obj, 'time_limit', None)
     if not hasattr(obj, 'events'):
         obj.events = ['pubmsg']
     else:
@@ -82,3 +96,191 @@ def parse_module(mod):
         if any(hasattr(func, attr) for attr in ('rules', 'commands')):
             callables.append(_parse_callable(func))
     return callables
+
+
+class DispatchTable(object):
+    """
+    Lookup table of the callables of all loaded modules, built once at load time so that
+    dispatching a message does not have to walk every module. Commands are indexed by
+    (event type, command as typed) for each of the prefix variants the command is
+    reachable by, while rule-bearing callables are grouped by event type as they need to
+    be checked against the whole message.
+    """
+    def __init__(self, modules):
+        self.commands = {}
+        rules = {}
+        for name, mod in modules.items():
+            for func in mod.__callables__:
+                if func.disabled is True:
+                    continue
+                for event_type in func.events:
+                    for command in getattr(func, 'commands', []):
+                        for key in _command_keys(event_type, command):
+                            self.commands.setdefault(key, []).append((name, func))
+                    for rule in getattr(func, 'rules', []):
+                        rules.setdefault(event_type, []).append((name, func, rule))
+        self.rules = {event_type: RuleMatcher(entries)
+                      for event_type, entries in rules.items()}
+
+    def get_commands(self, event_type, cmd):
+        """
+        :param event_type: type of the IRC event (pubmsg, privmsg, etc.)
+        :param cmd: lowercased first word of the message
+        :return: list of (module name, callable) tuples registered for the command
+        """
+        return self.commands.get((event_type, cmd), [])
+
+    def match_rules(self, event_type, msg):
+        """
+        :param event_type: type of the IRC event (pubmsg, privmsg, etc.)
+        :param msg: the full message of the event
+        :return: list of (module name, callable, match) tuples for every matching rule
+        """
+        if event_type not in self.rules:
+            return []
+        return self.rules[event_type].match(msg)
+
+
+class RuleMatcher(object):
+    """
+    Matches a message against the rules of all rule-bearing callables at once. Each rule
+    is reduced to a cheap prefilter when it is compiled: either the set of characters an
+    anchored rule has to start with, or the longest literal the rule requires. Literals
+    sharing a long enough prefix (like all the site URLs) are put behind that prefix as
+    a common gate, so for the typical message none of the regexes have to be run at all.
+    Rules that cannot be reduced are always searched.
+
+    Rules that pass their prefilter are searched in their registration order, giving the
+    same match objects that searching every rule would give.
+    """
+    def __init__(self, entries):
+        """
+        :param entries: list of (module name, callable, compiled rule) tuples
+        """
+        self.entries = entries
+        self.leading = {}
+        self.gates = []
+        self.unfiltered = []
+        literals = {}
+        for i, (_, _, rule) in enumerate(entries):
+            leading, literal = _rule_prefilter(rule)
+            if leading is not None:
+                for char in leading:
+                    self.leading.setdefault(char, []).append(i)
+            elif literal is not None:
+                ignorecase = bool(rule.flags & re.IGNORECASE)
+                literals.setdefault((ignorecase, literal), []).append(i)
+            else:
+                self.unfiltered.append(i)
+
+        for ignorecase in (False, True):
+            group = []
+            for literal in sorted(lit for icase, lit in literals
+                                  if icase is ignorecase):
+                if len(group) > 0 and \
+                        len(os.path.commonprefix([group[0], literal])) < MIN_GATE:
+                    self._add_gate(ignorecase, group, literals)
+                    group = []
+                group.append(literal)
+            if len(group) > 0:
+                self._add_gate(ignorecase, group, literals)
+
+    def _add_gate(self, ignorecase, group, literals):
+        gate = os.path.commonprefix(group)
+        # case-insensitive gates are first checked for their longest run of uncased
+        # characters, which can be done without casefolding the message
+        anchor = max(re.findall(r'[^a-zA-Z]+', gate), key=len, default='') \
+            if ignorecase else ''
+        self.gates.append((ignorecase, anchor, gate, [
+            (literal, literals[(ignorecase, literal)]) for literal in group
+        ]))
+
+    def match(self, msg):
+        candidates = list(self.unfiltered)
+        if msg[:1] in self.leading:
+            candidates.extend(self.leading[msg[:1]])
+        folded = None
+        for ignorecase, anchor, gate, literals in self.gates:
+            if ignorecase:
+                if anchor not in msg:
+                    continue
+                if folded is None:
+                    folded = msg.casefold()
+                text = folded
+            else:
+                text = msg
+            if gate not in text:
+                continue
+            for literal, indexes in literals:
+                if literal in text:
+                    candidates.extend(indexes)
+        if len(candidates) == 0:
+            return []
+
+        matches = []
+        for i in sorted(candidates):
+            name, func, rule = self.entries[i]
+            match = rule.search(msg)
+            if match:
+                matches.append((name, func, match))
+        return matches
+
+
+def _rule_prefilter(rule):
+    """
+    Works out a cheap prefilter for a compiled rule from its parsed form.
+
+    :param rule: compiled regex
+    :return: tuple of (set of characters the message has to start with, literal the
+             message has to contain), either or both of which can be None
+    """
+    # noinspection PyBroadException
+    try:
+        items = list(sre_parse.parse(rule.pattern, rule.flags))
+    except Exception:
+        return None, None
+    ignorecase = rule.flags & re.IGNORECASE
+
+    if len(items) > 1 and items[0][0] is sre_parse.AT and (
+            items[0][1] is sre_parse.AT_BEGINNING_STRING or
+            (items[0][1] is sre_parse.AT_BEGINNING and not rule.flags & re.MULTILINE)):
+        op, av = items[1]
+        chars = None
+        if op is sre_parse.LITERAL:
+            chars = {chr(av)}
+        elif op is sre_parse.IN and all(code is sre_parse.LITERAL for code, _ in av):
+            chars = {chr(c) for _, c in av}
+        if chars is not None and not (ignorecase and any(c.isalpha() for c in chars)):
+            return chars, None
+
+    best = ''
+    run = []
+    for op, av in items + [(None, None)]:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if len(run) > len(best):
+            best = ''.join(run)
+        run = []
+    if len(best) < MIN_LITERAL or (ignorecase and not best.isascii()):
+        return None, None
+    return None, best.casefold() if ignorecase else best
+
+
+def _command_keys(event_type, command):
+    keys = [(event_type, prefix + command) for prefix in COMMAND_PREFIXES]
+    if event_type == 'privmsg':
+        keys.append((event_type, command))
+    return keys
+
+
+def build_dispatch_table(modules):
+    """
+    Builds the dispatch table for the given modules. This needs to be called again
+    whenever a module is loaded or reloaded so that the table points at the current
+    callables.
+
+    :param modules: dictionary of loaded modules, as returned by load_modules
+    :return: DispatchTable
+    """
+    return DispatchTable(modules)
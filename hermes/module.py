@@ -86,3 +86,52 @@ def disabled():
         func.disabled = True
         return func
     return add_attribute
+
+
+def inline():
+    """
+    Synchronous functions are run in a thread pool so that they cannot block the other
+    commands. Defines a function that is cheap enough to run directly on the event loop.
+    :return:
+    """
+    def add_attribute(func):
+        func.inline = True
+        return func
+    return add_attribute
+
+
+def time_limit(seconds):
+    """
+    Defines how long a function may run before it is cancelled, instead of the default
+    timeout of the module runner.
+    :param seconds:
+    :return:
+    """
+    def add_attribute(func):
+        func.time_limit = seconds
+        return func
+    return add_attribute
+
+
+def latest_wins():
+    """
+    Defines a function where a new call for a channel (or private message sender)
+    cancels the call still running for it, so that only the latest call gets an answer.
+    :return:
+    """
+    def add_attribute(func):
+        func.latest_wins = True
+        return func
+    return add_attribute
+
+
+def priority():
+    """
+    Defines a function (like authentication) that must not wait behind the calls queued
+    for other modules, it is started as soon as it is received.
+    :return:
+    """
+    def add_attribute(func):
+        func.priority = True
+        return func
+    return add_attribute
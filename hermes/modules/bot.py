@@ -6,7 +6,7 @@ import os
 import sys
 
 from hermes.hermes import get_version_string
-from hermes.module import admin_only, privmsg, command
+from hermes.module import admin_only, privmsg, command, inline
 from hermes.utils import run_popen, file_tail
 
 
@@ -16,7 +16,9 @@ from hermes.utils import run_popen, file_tail
 def restart_bot(bot, connection, event):
     connection.privmsg(event.source.nick, "Saving persistent data")
     bot.logger.info("-> Saving data")
-    bot.storage.save()
+    bot.storage.save(wait=True)
+    # writes still queued for the disk cache would go with the process
+    bot.cache.close()
     connection.privmsg(event.source.nick, "Restarting the bot now")
     bot.logger.info("-> Restarting bot")
     pidfile = os.path.join(bot.dir, "hermes.pid")
@@ -66,6 +68,7 @@ def update_bot(bot, connection, event):
 @admin_only()
 @privmsg()
 @command("kill")
+@inline()
 def kill_bot(bot, *_):
     bot.logger.info("-> Killing bot")
     raise SystemExit
@@ -74,6 +77,7 @@ def kill_bot(bot, *_):
 @admin_only()
 @privmsg()
 @command("version")
+@inline()
 def get_version(_, connection, event):
     connection.privmsg(
         event.source.nick,
@@ -92,3 +96,12 @@ def view_log(bot, connection, event):
             connection.privmsg(event.source.nick, line.strip())
     except Exception as e:
         connection.privmsg(event.source.nick, e)
+
+
+@admin_only()
+@privmsg()
+@command('metrics')
+@inline()
+def show_metrics(bot, connection, event):
+    for name, metrics in bot.metrics().items():
+        connection.privmsg(event.source.nick, "{}: {}".format(name, metrics))
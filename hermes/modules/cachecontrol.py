@@ -3,6 +3,7 @@ Module to administrate the cache
 """
 
 from hermes.module import event, command, admin_only
+from hermes.utils import calculate_size
 
 @event('privmsg')
 @command('cache')
@@ -15,14 +16,41 @@ def cache_control(bot, connection, event):
     if command == 'clear':
         if len(event.args) == 1:
             bot.cache.clear()
+            bot.identities.clear()
             connection.privmsg(nick, "Cache cleared")
         else:
-            for key in event.args[1:]:
+            regions = [name for name in event.args[1:] if name in bot.cache.regions]
+            keys = [key for key in event.args[1:] if key not in bot.cache.regions]
+            for region in regions:
+                bot.cache.clear_region(region)
+                if region == 'users':
+                    # the identities are copies of what was cached of the users
+                    bot.identities.clear()
+            for key in keys:
                 bot.cache.clear(key)
-            connection.privmsg(nick, "Cleared cache keys {0}".format(", ".join(event.args[1:])))
+            if len(regions) > 0:
+                connection.privmsg(nick, "Cleared cache regions {0}".format(
+                    ", ".join(regions)))
+            if len(keys) > 0:
+                connection.privmsg(nick, "Cleared cache keys {0}".format(
+                    ", ".join(keys)))
     elif command == 'count':
-        connection.privmsg(nick, "Cache keys: {0}".format(str(len(bot.cache))))
+        connection.privmsg(nick, "Cache keys: {0} ({1})".format(
+            str(len(bot.cache)), ", ".join(
+                "{}: {}".format(name, len(region.entries))
+                for name, region in sorted(bot.cache.regions.items()))))
     elif command == 'expire':
         bot.cache.expire()
         connection.privmsg(nick, "Expired cache keys purged")
+    elif command == 'stats':
+        for namespace, stats in sorted(bot.cache.metrics().items()):
+            lookups = stats['hits'] + stats['misses']
+            hit_rate = stats['hits'] / lookups if lookups > 0 else 0
+            connection.privmsg(nick, "{}: {} keys, {} | hits: {} ({:.0%}) | "
+                               "misses: {} | expired: {} | evicted: {} | "
+                               "from disk: {}".format(
+                                   namespace, stats['entries'],
+                                   calculate_size(stats['bytes']), stats['hits'],
+                                   hit_rate, stats['misses'], stats['expired'],
+                                   stats['evicted'], stats['loaded']))
 
@@ -1,4 +1,4 @@
-from hermes.module import event, command
+from hermes.module import event, command, inline
 MAIN_CHANNEL = '#disabled'
 INTERVIEW_CHANNEL_MAXID = 5
 INTERVIEW_CHANNEL_FMT = '#disabled-{chanid}'
@@ -53,6 +53,7 @@ def process_arguments(bot, connection, event):
 
 @event('privmsg', 'pubmsg')
 @command('disabled-move')
+@inline()
 def disabled_move(bot, connection, event):
     try:
         target_user, target_chan = process_arguments(bot, connection, event)
@@ -68,6 +69,7 @@ def disabled_move(bot, connection, event):
 
 @event('privmsg', 'pubmsg')
 @command('disabled-kick')
+@inline()
 def disabled_kick(bot, connection, event):
     try:
         target_user, target_chan = process_arguments(bot, connection, event)
@@ -8,11 +8,23 @@ Note, because the bot is using SAJOIN to add users to the channels that they req
 we cannot use a +b ban on a user to prevent them from joining a channel. Instead, we have to
 revoke their IRC privileges through Gazelle, then kick the user from the channels.
 """
+import asyncio
 from datetime import timedelta, datetime
-from hermes.module import privmsg, command, help_message, example, admin_only
+from hermes.identity import make_vhost
+from hermes.module import privmsg, command, help_message, example, admin_only, \
+    inline, time_limit, priority
 
 
 timeouts = {}
+# how long users are kept in the cache, and for how long of that they can enter without
+# waiting on the site to check them first
+USER_TTL = timedelta(30)
+MAX_STALE = timedelta(7)
+# how long to wait on the site (retries included) before falling back on the cached
+# user, which leaves enter time to answer within its time limit
+API_TIMEOUT = 10
+# background checks of users that were let in from the cache
+revalidations = set()
 
 
 def validate_irckey(user, irckey):
@@ -29,6 +41,8 @@ def validate_irckey(user, irckey):
 
 @privmsg()
 @command("enter")
+@time_limit(15)
+@priority()
 @help_message("Use this command to have the bot add you to any official channel")
 @example("enter <channels> <site_username> <site_irckey>",
          "enter #orpheus itismadness 123456",
@@ -71,22 +85,26 @@ async def enter(bot, connection, event):
         )
     )
 
-    # Pull fresh copy of user, use the cached version if no user is found
+    # Let the user in straight away if they were let in not too long ago with the same
+    # key, and check them against the site in the background. Otherwise pull a fresh
+    # copy of the user, use the cached version if no user is found
     key = "user_{0}".format(username)
-    user = await bot.api.get_user(username)
-    if user is None:
-        user = bot.cache[key]
+    user = get_recent_user(bot, key)
+    revalidate = user is not None and validate_irckey(user, password)[0]
+    if not revalidate:
+        user = await bot.api.get_user(username, fresh=True, priority=bot.api.HIGH,
+                                      timeout=API_TIMEOUT)
+        if user is None:
+            user = bot.cache.get(key, 'users')
     valid, error = validate_irckey(user, password)
 
     if valid:
-        bot.cache.store(key, user, timedelta(30))
+        if not revalidate:
+            bot.cache.store(key, user, USER_TTL, 'users')
+        vhost = make_vhost(bot, user)
         connection.send_raw("CHGIDENT {} {}".format(sent_nick, user.ID))
-        connection.send_raw("CHGHOST {} {}.{}.{}".format(
-            sent_nick,
-            user.Username,
-            user.ClassName.replace(" ", ""),
-            bot.config.site.tld
-        ))
+        connection.send_raw("CHGHOST {} {}".format(sent_nick, vhost))
+        bot.identities.add(vhost, user, sent_nick)
         joined = []
         not_real = []
         not_joined = []
@@ -135,17 +153,75 @@ async def enter(bot, connection, event):
         if len(joined) > 0:
             connection.privmsg(sent_nick, "Welcome to #{}".format(", #".join(joined)))
             bot.logger.debug("-> {} entered #{}".format(sent_nick, ", #".join(joined)))
+
+        if revalidate:
+            task = asyncio.ensure_future(
+                revalidate_user(bot, connection, sent_nick, username, password, vhost,
+                                joined, event.source.user, event.source.host)
+            )
+            revalidations.add(task)
+            task.add_done_callback(revalidations.discard)
     else:
         connection.privmsg(sent_nick, error)
 
 
+def get_recent_user(bot, key):
+    """
+    :return: the cached user under the key if it was stored no longer than MAX_STALE
+             ago, None otherwise
+    """
+    entry = bot.cache.get_entry(key, 'users')
+    if entry is None or entry.expired():
+        return None
+    age = USER_TTL.total_seconds() - entry.remaining()
+    if age > MAX_STALE.total_seconds():
+        return None
+    return entry.value
+
+
+async def revalidate_user(bot, connection, nick, username, password, vhost, channels,
+                          ident, host):
+    """
+    Checks a user that was let in from the cache against the site, and kicks them back
+    out of the channels they were let into if they should not have been, as well as
+    giving them back the ident and host they had before they entered (so the vhost
+    does not vouch for them anymore). If the site cannot be reached, the user keeps the
+    benefit of the doubt.
+    """
+    key = "user_{0}".format(username)
+    user = await bot.api.get_user(username, fresh=True, priority=bot.api.HIGH)
+    if user is None:
+        return
+    valid, error = validate_irckey(user, password)
+    if valid:
+        bot.cache.store(key, user, USER_TTL, 'users')
+        if make_vhost(bot, user) == vhost:
+            bot.identities.add(vhost, user, nick)
+        else:
+            bot.identities.forget(nick)
+        return
+
+    bot.cache.clear(key, 'users')
+    connection.send_raw("CHGIDENT {} {}".format(nick, ident))
+    connection.send_raw("CHGHOST {} {}".format(nick, host))
+    bot.identities.forget(nick)
+    bot.identities.forget(host=vhost)
+    bot.logger.info("-> {} (username: {}) failed revalidation: {}".format(
+        nick, username, error))
+    for channel in channels:
+        connection.kick("#" + channel, nick, error)
+    connection.privmsg(nick, error)
+
+
 @privmsg()
 @admin_only()
 @command("timeout")
+@inline()
 def timeout(bot, connection, event):
     global timeouts
 
     client_name = event.args[-2]
     site_name = event.args[-1]
     connection.send_raw("KILL {} Been placed on a 1 day timeout".format(client_name))
+    bot.identities.forget(client_name)
     timeouts[site_name.lower()] = datetime.now()
@@ -4,7 +4,8 @@ Administration is available from the designated FLS channel or via PM from FLS /
 """
 import re
 
-from hermes.module import event, command, rule
+from hermes.identity import authorize
+from hermes.module import event, command, rule, inline
 from pprint import pprint, pformat
 
 key = "canned_responses"
@@ -16,6 +17,7 @@ def setup(bot):
 
 @event("pubmsg", "privmsg")
 @rule(r'^[!\.][a-zA-Z0-9]+')
+@inline()
 def can_trigger(bot, connection, event, match):
     trigger = event.cmd.lower().strip('!.')
     target = event.source.nick if event.type == 'privmsg' else event.target
@@ -93,25 +95,9 @@ def can_list(bot, connection, event, args):
 
 
 async def check_auth(bot, connection, host, nick, prompt):
-    split_host = host.split(".")
-    if len(split_host) != 4:
-        return False
-
-    if host.endswith(bot.config.site.tld):
-        # Make sure that the one issuing the command is authorized to do so
-        user = await bot.api.get_user(split_host[0])
-        if user is None:
-            if prompt:
-                connection.notice(nick, "You must be authed through the bot to administer \
-                        canned responses.")
-            return False
-
-        if bot.config.fls.class_id in user['SecondaryClasses'] or \
-                user['Level'] >= bot.config.fls.min_level:
-                    return True
-        else:
-            if prompt:
-                connection.notice(nick, "You are not authorized to do this command!")
-            return False
+    return await authorize(bot, connection, host, nick, prompt,
+                           "administer canned responses",
+                           min_level=bot.config.fls.min_level,
+                           class_id=bot.config.fls.class_id)
 
 
@@ -2,7 +2,8 @@
 Module to handle interview queues
 """
 
-from hermes.module import event, command
+from hermes.identity import authorize
+from hermes.module import event, command, inline, priority
 from time import time
 import re
 
@@ -65,25 +66,9 @@ def is_url_reused(bot, url):
 
 
 async def check_auth(bot, connection, host, nick, prompt):
-    split_host = host.split(".")
-    if len(split_host) != 4:
-        return False
-
-    if host.endswith(bot.config.site.tld):
-        # Make sure that the one issuing the command is authorized to do so
-        user = await bot.api.get_user(split_host[0])
-        if user is None:
-            if prompt:
-                connection.notice(nick, "You must be authed through the bot to start an interview.")
-            return False
-
-        if bot.config.interview.class_id in user['SecondaryClasses'] or \
-                user['Level'] >= bot.config.interview.min_level:
-            return True
-        else:
-            if prompt:
-                connection.notice(nick, "You are not authorized to do this command!")
-            return False
+    return await authorize(bot, connection, host, nick, prompt, "start an interview",
+                           min_level=bot.config.interview.min_level,
+                           class_id=bot.config.interview.class_id)
 
 
 def is_in_channel(user, channel):
@@ -161,6 +146,7 @@ async def queue(bot, connection, event):
 
 @event("privmsg")
 @command("info")
+@inline()
 def info(bot, connection, event):
     """
 
@@ -185,6 +171,7 @@ def info(bot, connection, event):
 
 @event("privmsg", "pubmsg")
 @command("next")
+@priority()
 async def next_interview(bot, connection, event):
     """
 
@@ -223,6 +210,7 @@ async def next_interview(bot, connection, event):
 
 @event("privmsg")
 @command("queue_length")
+@inline()
 def queue_length(bot, connection, event):
     connection.notice(event.source.nick, "The queue currently has {} people "
                                          "in it.".format(len(bot.storage[key])))
@@ -230,6 +218,7 @@ def queue_length(bot, connection, event):
 
 @event("privmsg")
 @command("postpone")
+@inline()
 def postpone(bot, connection, event):
     """
 
@@ -259,6 +248,7 @@ def postpone(bot, connection, event):
 
 @event("privmsg")
 @command("cancel")
+@inline()
 def cancel(bot, connection, event):
     """
 
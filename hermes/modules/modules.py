@@ -34,6 +34,7 @@ def reload_module(bot, connection, event):
         # noinspection PyBroadException
         try:
             load_module(bot.modules, bot.modules[mod].__mod_path__)
+            bot.rebuild_dispatch_table()
             if hasattr(bot.modules[mod], 'setup'):
                 bot.modules[mod].setup(bot)
             bot.logger.info("-> Reloaded module: {}".format(mod))
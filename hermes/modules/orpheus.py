@@ -1,5 +1,9 @@
 from re import IGNORECASE
-from hermes.module import rule, event, disabled
+from hermes.module import rule, event, disabled, latest_wins, time_limit
+
+# previews are worthless once the conversation has moved on, so don't wait around for a
+# slow site, and only answer the latest link posted in a channel
+PREVIEW_TIMEOUT = 15
 
 def check_perms(bot, channel, level):
     channel = channel.lstrip('#').lower()
@@ -13,6 +17,8 @@ def check_perms(bot, channel, level):
     return True
 
 @event("pubmsg")
+@time_limit(PREVIEW_TIMEOUT)
+@latest_wins()
 @rule(r"https:\/\/orpheus\.network\/forums\.php\?[a-zA-Z0-9=&]*threadid=([0-9]+)", IGNORECASE)
 async def parse_thread_url(bot, connection, event, match):
     """
@@ -34,6 +40,8 @@ async def parse_thread_url(bot, connection, event, match):
 
 
 @event("pubmsg")
+@time_limit(PREVIEW_TIMEOUT)
+@latest_wins()
 @rule(r"https:\/\/orpheus\.network\/wiki\.php\?[a-zA-Z0-9=&]*id=([0-9]+)")
 async def parse_wiki_url(bot, connection, event, match):
     wiki = await bot.api.get_wiki(int(match.group(1)))
@@ -46,6 +54,8 @@ async def parse_wiki_url(bot, connection, event, match):
 
 
 @event("pubmsg")
+@time_limit(PREVIEW_TIMEOUT)
+@latest_wins()
 @rule(r"https:\/\/orpheus\.network\/user\.php\?[a-zA-Z0-9=&]*id=([0-9]+)")
 async def parse_user_url(bot, connection, event, match):
     user = await bot.api.get_user(int(match.group(1)))
@@ -57,6 +67,8 @@ async def parse_user_url(bot, connection, event, match):
 
 
 @event("pubmsg")
+@time_limit(PREVIEW_TIMEOUT)
+@latest_wins()
 @rule(r"https:\/\/orpheus\.network\/requests\.php\?[a-zA-Z0-9=&]*id=([0-9]+)")
 async def parse_request_url(bot, connection, event, match):
     request = await bot.api.get_request(int(match.group(1)))
@@ -67,6 +79,8 @@ async def parse_request_url(bot, connection, event, match):
 
 
 @event("pubmsg")
+@time_limit(PREVIEW_TIMEOUT)
+@latest_wins()
 @rule(r"https:\/\/orpheus\.network\/torrents\.php\?[a-zA-Z0-9=&]*torrentid=([0-9]+)")
 async def parse_torrent_url(bot, connection, event, match):
     torrent = await bot.api.get_torrent(int(match.group(1)))
@@ -85,6 +99,8 @@ async def parse_torrent_url(bot, connection, event, match):
 
 
 @event("pubmsg")
+@time_limit(PREVIEW_TIMEOUT)
+@latest_wins()
 @rule(r"https:\/\/orpheus\.network\/torrents\.php[a-zA-Z0-9=&\?]*[\?&]id=([0-9]+)$")
 async def parse_torrent_group_url(bot, connection, event, match):
     group = await bot.api.get_torrent_group(int(match.group(1)))
@@ -95,6 +111,8 @@ async def parse_torrent_group_url(bot, connection, event, match):
 
 
 @event("pubmsg")
+@time_limit(PREVIEW_TIMEOUT)
+@latest_wins()
 @rule(r"https:\/\/orpheus\.network\/artist\.php\?[a-zA-Z0-9=&]*id=([0-9]+)")
 async def parse_artist_url(bot, connection, event, match):
     artist = await bot.api.get_artist(int(match.group(1)))
@@ -104,6 +122,8 @@ async def parse_artist_url(bot, connection, event, match):
 
 
 @event("pubmsg")
+@time_limit(PREVIEW_TIMEOUT)
+@latest_wins()
 @rule(r"https:\/\/orpheus\.network\/collages\.php\?[a-zA-Z0-9=&]*id=([0-9]+)")
 async def parse_collage_url(bot, connection, event, match):
     collage = await bot.api.get_collage(int(match.group(1)))
@@ -5,6 +5,7 @@ Administration is available  via PM from staff
 import re
 import random
 
+from hermes.identity import authorize
 from hermes.module import event, command, rule
 from pprint import pprint, pformat
 
@@ -87,24 +88,7 @@ def quote_list(bot, connection, event, args):
 
 
 async def check_auth(bot, connection, host, nick, prompt):
-    split_host = host.split(".")
-    if len(split_host) != 4:
-        return False
-
-    if host.endswith(bot.config.site.tld):
-        # Make sure that the one issuing the command is authorized to do so
-        user = await bot.api.get_user(split_host[0])
-        if user is None:
-            if prompt:
-                connection.notice(nick, "You must be authed through the bot to administer \
-                        quotes.")
-            return False
-
-        if user['Level'] >= bot.config.quote.min_level:
-            return True
-        else:
-            if prompt:
-                connection.notice(nick, "You are not authorized to do this command!")
-            return False
+    return await authorize(bot, connection, host, nick, prompt, "administer quotes",
+                           min_level=bot.config.quote.min_level)
 
 
@@ -5,11 +5,12 @@ that their paranoia is set sufficiently low enough that it is viewable (we don't
 if the requesting party has the right permissions to override paranoia if asking in a privmsg)
 """
 
-from hermes.module import event, command
+from hermes.module import event, command, time_limit
 
 
 @event("pubmsg")
 @command("user", "u")
+@time_limit(15)
 async def show_user(bot, connection, event):
     """
 
@@ -1,3 +1,4 @@
+from hermes.identity import get_identity, is_authorized
 from hermes.module import event as hermes_event, command
 
 
@@ -125,15 +126,11 @@ class WhoisCallbackManager:
 
 
 async def check_auth(bot, host, target_user):
-    split_host = host.split('.')
-    if len(split_host) != 4 or not host.endswith(bot.config.site.tld):
-        return False
-
-    user = await bot.api.get_user(split_host[0])
+    user = await get_identity(bot, host)
     if user is None:
         return False
 
-    if user['Level'] >= bot.config.site.mod_level:
+    if is_authorized(user, min_level=bot.config.site.mod_level):
         return user
 
     if bot.config.interview.class_id in user['SecondaryClasses']:
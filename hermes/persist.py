@@ -2,32 +2,137 @@
 Stores data through reboots.
 """
 
+import glob
 import pickle
 import os
+import threading
 import traceback
 
 from .utils import DotDict
 
+
 class PersistentStorage(object):
-    def __init__(self, path):
+    """
+    Storage that is kept in a snapshot at path, plus a journal of the changes made
+    since that snapshot, which are appended as small records as they are made and
+    replayed on top of the snapshot when the storage is loaded. Once the journal grows
+    past max_journal bytes, sync() compacts it into a new snapshot.
+
+    The journal is split into segments (path.journal.<epoch>). A snapshot starts a new
+    segment and is written by a forked child, from its copy-on-write view of the
+    storage at that moment, so the bot carries on while it is written. The snapshot
+    of an epoch holds all changes of the segments before it, which are deleted once it
+    is safely on disk. It is written to a temporary file, synced and renamed over the
+    old one, so persist.dat is always a whole snapshot.
+
+    Dicts and lists put in the storage are wrapped in a JournaledDict or JournaledList,
+    which journal their changes, as do the dicts nested in dicts. Anything else (such as
+    the objects in the lists, or values stored with journaled=False) is only written
+    out with the snapshots, so should be replaced rather than changed in place.
+    """
+    MAX_JOURNAL = 1024 * 1024
+
+    def __init__(self, path, max_journal=None):
         self.path = path
+        self.max_journal = max_journal if max_journal is not None \
+            else self.MAX_JOURNAL
+        # epoch of the snapshot on disk
+        self.epoch = 0
+        # pid and epoch of the child writing a snapshot
+        self.snapshot = None
+        # once closed, another storage may have been opened on the same files, so
+        # this one no longer writes to them
+        self.closed = False
+        storage = DotDict()
         if os.path.isfile(path):
             try:
                 with open(path, 'rb') as f:
-                    self.storage = pickle.load(f)
+                    storage = pickle.load(f)
+                    try:
+                        self.epoch = pickle.load(f)
+                    except EOFError:
+                        # written before the storage had a journal
+                        pass
             except:
                 print(traceback.format_exc())
-                self.storage = DotDict()
-        else:
-            self.storage = DotDict()
+                storage = DotDict()
 
-    def save(self):
-        try:
-            with open(self.path, 'wb') as f:
-                pickle.dump(self.storage, f)
-        except:
-            print(traceback.format_exc())
-            pass
+        epoch, size = self.epoch, None
+        for segment_epoch, segment in _segments(path):
+            if segment_epoch < self.epoch:
+                os.unlink(segment)
+            else:
+                epoch, size = segment_epoch, _replay(storage, segment)
+        self.journal = Journal(path, epoch, size)
+        self.storage = DotDict()
+        for key, value in storage.items():
+            self.storage[key] = _wrap(value, self.journal, (key,))
+
+    def save(self, wait=False):
+        """
+        Writes a snapshot of the whole storage in the background, and starts a new
+        journal segment after it
+
+        :param wait: wait for the snapshot to be written (which holds up any changes
+                     to the storage until it is)
+        :return: whether the snapshot was started, which it is not if another one is
+                 still being written
+        """
+        with self.journal.lock:
+            if self.closed:
+                return False
+            if self.snapshot is not None and not self._reap(wait):
+                return False
+            epoch = self.journal.epoch + 1
+            self.journal.rotate(epoch)
+            if not hasattr(os, 'fork'):
+                try:
+                    self._write(epoch)
+                    self._saved(epoch)
+                except:
+                    print(traceback.format_exc())
+                return True
+            pid = os.fork()
+            if pid == 0:
+                # the child only writes the snapshot, and leaves without running any
+                # of the cleanup of the bot (nor printing, as the other threads of the
+                # bot may have held the lock of stdout when it was forked)
+                code = 1
+                try:
+                    self._write(epoch)
+                    code = 0
+                finally:
+                    os._exit(code)
+            self.snapshot = (pid, epoch)
+            if wait:
+                self._reap(True)
+        return True
+
+    def sync(self):
+        """
+        Flushes the journal to disk, and compacts it into a snapshot if it has grown
+        past max_journal
+
+        :return: whether a snapshot was started
+        """
+        self.journal.sync()
+        with self.journal.lock:
+            if self.closed:
+                return False
+            if self.snapshot is not None:
+                self._reap()
+            elif self.journal.size > self.max_journal:
+                return self.save()
+        return False
+
+    def close(self):
+        with self.journal.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.snapshot is not None:
+                self._reap(True)
+            self.journal.close()
 
     def __iter__(self):
         return self.storage.__iter__()
@@ -47,8 +152,17 @@ class PersistentStorage(object):
     def __contains__(self, key):
         return key in self.storage
 
-    def store(self, key, value):
-        self.storage[key] = value
+    def store(self, key, value, journaled=True):
+        """
+        :param journaled: whether to wrap and journal the value, which otherwise is
+                          only persisted with the next snapshot
+        """
+        with self.journal.lock:
+            if journaled:
+                self.storage[key] = _wrap(value, self.journal, (key,))
+                self.journal.append(('set', (), key, value))
+            else:
+                self.storage[key] = value
 
     def get(self, key):
         if key in self.storage:
@@ -57,9 +171,357 @@ class PersistentStorage(object):
             return None
 
     def clear(self, key=None):
-        if key:
-            if key in self.storage:
-                del self.storage[key]
+        with self.journal.lock:
+            if key:
+                if key in self.storage:
+                    del self.storage[key]
+                    self.journal.append(('del', (), key))
+            else:
+                self.storage.clear()
+                self.journal.append(('clear', ()))
+
+    def _write(self, epoch):
+        """
+        Writes the snapshot of the epoch atomically, through a temporary file that is
+        synced to disk before it is renamed over the old snapshot
+        """
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(self.storage, f)
+                pickle.dump(epoch, f)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        os.replace(temp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _reap(self, wait=False):
+        """
+        Checks on the child writing the snapshot, and drops the journal segments the
+        snapshot holds once it is written. If it failed, they are kept (and replayed
+        on the older snapshot).
+
+        :return: whether the child is done
+        """
+        pid, epoch = self.snapshot
+        try:
+            done, status = os.waitpid(pid, 0 if wait else os.WNOHANG)
+        except ChildProcessError:
+            done, status = pid, 1
+        if done == 0:
+            return False
+        self.snapshot = None
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            self._saved(epoch)
         else:
-            self.storage.clear()
+            print("Writing the snapshot of {} failed ({})".format(self.path, status))
+        return True
+
+    def _saved(self, epoch):
+        self.epoch = epoch
+        for segment_epoch, segment in _segments(self.path):
+            if segment_epoch < epoch:
+                os.unlink(segment)
+
+
+class Journal(object):
+    """
+    Append-only segments of the changes to the storage, each of which starts with the
+    epoch it is of. Appends are flushed straight away, so they survive the bot
+    crashing, and sync() makes them survive the machine crashing too.
+
+    The lock is held while a change is made and journaled, so that the journal has the
+    changes in the order they were made in.
+    """
+    def __init__(self, path, epoch, size=None):
+        """
+        :param path: path of the snapshot the journal is of
+        :param size: size of the existing segment of the epoch to continue, a new
+                     segment is started if None
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.epoch = epoch
+        self.size = 0
+        self.dirty = False
+        self.file = None
+        if size is None:
+            self.rotate(epoch)
+        else:
+            self.file = open(_segment_path(path, epoch), 'r+b')
+            self.file.truncate(size)
+            self.file.seek(size)
+            self.size = size
+
+    def append(self, record):
+        try:
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            print(traceback.format_exc())
+            return
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            self.dirty = True
+
+    def rotate(self, epoch):
+        """
+        Closes the current segment, and starts the segment of the epoch
+        """
+        with self.lock:
+            if self.file is not None:
+                self.close()
+            self.file = open(_segment_path(self.path, epoch), 'wb')
+            self.epoch = epoch
+            self.size = 0
+            self.append(('epoch', epoch))
+            self.sync()
+
+    def sync(self):
+        """
+        Syncs the segment to disk outside of the lock, so changes can still be made
+        while it is synced. It syncs a duplicate of the file descriptor, which stays
+        valid if the segment is closed in the meantime.
+        """
+        with self.lock:
+            if not self.dirty or self.file.closed:
+                return
+            fd = os.dup(self.file.fileno())
+            self.dirty = False
+        try:
+            os.fsync(fd)
+        except OSError:
+            self.dirty = True
+            raise
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
+
+
+class JournaledDict(dict):
+    """
+    Dict that journals its changes, under the path of keys it is at in the storage
+    """
+    __slots__ = ('journal', 'path')
+
+    def __init__(self, journal, path, data=()):
+        super().__init__()
+        self.journal = journal
+        self.path = path
+        for key, value in dict(data).items():
+            super().__setitem__(key, _wrap(value, journal, path + (key,)))
+
+    def __setitem__(self, key, value):
+        with self.journal.lock:
+            super().__setitem__(key, _wrap(value, self.journal, self.path + (key,)))
+            self.journal.append(('set', self.path, key, value))
+
+    def __delitem__(self, key):
+        with self.journal.lock:
+            super().__delitem__(key)
+            self.journal.append(('del', self.path, key))
 
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *default):
+        with self.journal.lock:
+            if key not in self:
+                return super().pop(key, *default)
+            value = super().pop(key)
+            self.journal.append(('del', self.path, key))
+            return value
+
+    def popitem(self):
+        with self.journal.lock:
+            key, value = super().popitem()
+            self.journal.append(('del', self.path, key))
+            return key, value
+
+    def setdefault(self, key, default=None):
+        with self.journal.lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    def update(self, *args, **kwargs):
+        with self.journal.lock:
+            for key, value in dict(*args, **kwargs).items():
+                self[key] = value
+
+    def clear(self):
+        with self.journal.lock:
+            super().clear()
+            self.journal.append(('clear', self.path))
+
+    def __reduce__(self):
+        # pickled as a plain dict, without the journal
+        return dict, (), None, None, iter(self.items())
+
+
+class JournaledList(list):
+    """
+    List that journals its changes, under the path of keys it is at in the storage.
+    Its items are not wrapped, as their position (and so their path) shifts.
+    """
+    __slots__ = ('journal', 'path')
+
+    def __init__(self, journal, path, data=()):
+        super().__init__(data)
+        self.journal = journal
+        self.path = path
+
+    def __setitem__(self, index, value):
+        with self.journal.lock:
+            super().__setitem__(index, value)
+            self.journal.append(('set', self.path, index, value))
+
+    def __delitem__(self, index):
+        with self.journal.lock:
+            super().__delitem__(index)
+            self.journal.append(('del', self.path, index))
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, count):
+        with self.journal.lock:
+            super().__imul__(count)
+            self._replace()
+        return self
+
+    def append(self, value):
+        with self.journal.lock:
+            super().append(value)
+            self.journal.append(('append', self.path, value))
+
+    def extend(self, values):
+        with self.journal.lock:
+            values = list(values)
+            super().extend(values)
+            self.journal.append(('extend', self.path, values))
+
+    def insert(self, index, value):
+        with self.journal.lock:
+            super().insert(index, value)
+            self.journal.append(('insert', self.path, index, value))
+
+    def pop(self, index=-1):
+        with self.journal.lock:
+            value = super().pop(index)
+            self.journal.append(('pop', self.path, index))
+            return value
+
+    def remove(self, value):
+        with self.journal.lock:
+            del self[self.index(value)]
+
+    def clear(self):
+        with self.journal.lock:
+            super().clear()
+            self.journal.append(('clear', self.path))
+
+    def sort(self, *args, **kwargs):
+        with self.journal.lock:
+            super().sort(*args, **kwargs)
+            self._replace()
+
+    def reverse(self):
+        with self.journal.lock:
+            super().reverse()
+            self._replace()
+
+    def _replace(self):
+        self.journal.append(('replace', self.path, list(self)))
+
+    def __reduce__(self):
+        # pickled as a plain list, without the journal
+        return list, (), None, iter(self)
+
+
+def _wrap(value, journal, path):
+    if type(value) is dict or isinstance(value, JournaledDict):
+        return JournaledDict(journal, path, value)
+    if type(value) is list or isinstance(value, JournaledList):
+        return JournaledList(journal, path, value)
+    return value
+
+
+def _apply(storage, record):
+    """
+    Applies a record of the journal to the (plain) storage
+    """
+    op, path, args = record[0], record[1], record[2:]
+    target = storage
+    for key in path:
+        target = target[key]
+    if op == 'set':
+        target[args[0]] = args[1]
+    elif op == 'del':
+        del target[args[0]]
+    elif op == 'replace':
+        target[:] = args[0]
+    else:
+        # clear, append, extend, insert and pop
+        getattr(target, op)(*args)
+
+
+def _segment_path(path, epoch):
+    return '{}.journal.{}'.format(path, epoch)
+
+
+def _segments(path):
+    """
+    :return: list of the epoch and path of the journal segments of the snapshot at
+             path, in order of epoch
+    """
+    segments = []
+    for segment in glob.glob(glob.escape(path) + '.journal*'):
+        try:
+            with open(segment, 'rb') as f:
+                op, epoch = pickle.load(f)
+        except Exception:
+            # a segment that did not get as far as its epoch
+            os.unlink(segment)
+            continue
+        if op == 'epoch':
+            segments.append((epoch, segment))
+    return sorted(segments)
+
+
+def _replay(storage, path):
+    """
+    Applies the changes in the journal segment at path to the storage. A record torn
+    by a crash ends the segment.
+
+    :return: the size of the segment up to its last whole record
+    """
+    with open(path, 'rb') as f:
+        pickle.load(f)
+        while True:
+            size = f.tell()
+            try:
+                record = pickle.load(f)
+            except Exception:
+                break
+            try:
+                _apply(storage, record)
+            except (LookupError, TypeError, ValueError):
+                print(traceback.format_exc())
+    return size
@@ -0,0 +1,146 @@
+"""
+Token bucket rate limiting of the commands that people send to the bot, so that no one
+nick or channel can have the bot flood the site API or the IRC server.
+"""
+
+import logging
+import time
+from collections import Counter
+
+LOGGER = logging.getLogger('hermes')
+
+
+class TokenBucket(object):
+    """
+    Bucket that holds up to capacity tokens and is refilled with rate tokens per second.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def consume(self, amount=1, now=None):
+        if self.refill(now) < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def wait_time(self, amount=1, now=None):
+        """
+        :return: seconds until the bucket holds the given amount of tokens
+        """
+        missing = amount - self.refill(now)
+        return 0 if missing <= 0 else missing / self.rate
+
+    def is_full(self, now=None):
+        return self.refill(now) >= self.capacity
+
+
+class RateLimiter(object):
+    """
+    Keeps a bucket per user (by host) and per channel for every command. Commands
+    without limits of their own in the config share the default buckets of the user and
+    channel.
+
+    The config is the rate_limit section of config.yml:
+
+        rate_limit:
+          user:
+            rate: 5
+            per: 10
+          channel:
+            rate: 20
+            per: 10
+          commands:
+            user:
+              user:
+                rate: 2
+                per: 10
+
+    where rate is the number of commands allowed for every per seconds. Commands are
+    named without their prefix, and rules by the name of their function.
+    """
+    DEFAULTS = {
+        'user': {'rate': 5, 'per': 10},
+        'channel': {'rate': 20, 'per': 10},
+    }
+    MAX_BUCKETS = 10000
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.limits = {'*': {}}
+        for scope, default in self.DEFAULTS.items():
+            self.limits['*'][scope] = _bucket_args(config.get(scope) or default)
+        for command, scopes in (config.get('commands') or {}).items():
+            self.limits[command] = {
+                scope: _bucket_args(scopes[scope]) if scope in scopes
+                else self.limits['*'][scope]
+                for scope in self.DEFAULTS
+            }
+        self.buckets = {}
+        self.dropped = Counter()
+
+    def allow(self, command, user, channel=None):
+        """
+        Takes a token from the buckets of the user and channel for the command, if both
+        have one to spare.
+
+        :param command: name of the command (or rule function)
+        :param user: host (or nick) of who sent the command
+        :param channel: channel the command was sent in, None for private messages
+        :return: whether the command may be run
+        """
+        now = time.monotonic()
+        limits = self.limits[command] if command in self.limits else self.limits['*']
+        name = command if command in self.limits else '*'
+        buckets = [self._get_bucket((name, 'user', user), limits['user'], now)]
+        if channel is not None:
+            buckets.append(
+                self._get_bucket((name, 'channel', channel), limits['channel'], now))
+
+        if any(bucket.refill(now) < 1 for bucket in buckets):
+            self.dropped[command] += 1
+            LOGGER.debug(f"Rate limited {command} from {user} in {channel}")
+            return False
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return True
+
+    def _get_bucket(self, key, args, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_BUCKETS:
+                self._prune(now)
+            bucket = self.buckets[key] = TokenBucket(*args, now=now)
+        return bucket
+
+    def _prune(self, now):
+        # a full bucket is no different from a new one, so it can be forgotten
+        for key in [key for key, bucket in self.buckets.items() if bucket.is_full(now)]:
+            del self.buckets[key]
+        # and if that wasn't enough, forget the oldest buckets
+        excess = len(self.buckets) - self.MAX_BUCKETS * 3 // 4
+        for key in list(self.buckets)[:max(excess, 0)]:
+            del self.buckets[key]
+
+    def metrics(self):
+        return {'buckets': len(self.buckets), 'dropped': dict(self.dropped)}
+
+
+def _bucket_args(limit):
+    """
+    :return: (rate, capacity) of the bucket for a limit of rate commands per seconds
+    """
+    return limit['rate'] / limit['per'], limit['rate']
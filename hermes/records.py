@@ -0,0 +1,128 @@
+"""
+Compact records of the objects fetched from the Gazelle API, holding only the fields
+that the modules read of them, so that what goes in the cache (and from there into the
+persistent storage) is a fraction of the full response.
+"""
+
+
+class Record(object):
+    """
+    Base of the records, every record lists its fields in __slots__ and may name the
+    record type of its nested objects in NESTED. Fields can be read both as attributes
+    and as items, where fields that were missing from the response are None.
+    """
+    __slots__ = ()
+    NESTED = {}
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+        for field in self.__slots__[len(values):]:
+            setattr(self, field, None)
+
+    @classmethod
+    def project(cls, response):
+        """
+        :param response: the response (or nested object) to take the fields from
+        :return: record of the fields of the response
+        """
+        values = []
+        for field in cls.__slots__:
+            value = response.get(field)
+            if value is not None and field in cls.NESTED:
+                value = cls.NESTED[field].project(value)
+            values.append(value)
+        return cls(*values)
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field):
+        return field in self.__slots__ and getattr(self, field) is not None
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def values(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.values() == other.values()
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={!r}'.format(field, getattr(self, field)) for field in self.__slots__
+        ))
+
+    def __reduce__(self):
+        # only the values, instead of the names of the fields for every object
+        return self.__class__, self.values()
+
+
+class DisplayStats(Record):
+    __slots__ = ('Uploaded', 'Downloaded', 'Ratio')
+
+
+class User(Record):
+    __slots__ = ('ID', 'Username', 'ClassName', 'Class', 'SecondaryClasses', 'Level',
+                 'Enabled', 'DisableIRC', 'IRCKey', 'DisplayStats', 'UserPage')
+    NESTED = {'DisplayStats': DisplayStats}
+
+
+class Topic(Record):
+    __slots__ = ('Forum', 'Title', 'MinClassRead')
+
+
+class Wiki(Record):
+    __slots__ = ('Title', 'MinClassRead')
+
+
+class Request(Record):
+    __slots__ = ('DisplayArtists', 'Title', 'Year')
+
+
+class Torrent(Record):
+    __slots__ = ('DisplayArtists', 'Name', 'Year', 'ReleaseType', 'Media', 'Format',
+                 'HasLog', 'HasLogDB', 'LogScore')
+
+
+class TorrentGroup(Record):
+    __slots__ = ('DisplayArtists', 'Name', 'Year', 'ReleaseType')
+
+
+class Artist(Record):
+    __slots__ = ('Name',)
+
+
+class Collage(Record):
+    __slots__ = ('Name', 'Category')
+
+
+# record type of the response of each call, by the action and req parameters of it
+PROJECTIONS = {
+    ('user', None): User,
+    ('forum', None): Topic,
+    ('wiki', None): Wiki,
+    ('request', None): Request,
+    ('torrent', 'torrent'): Torrent,
+    ('torrent', 'group'): TorrentGroup,
+    ('artist', None): Artist,
+    ('collage', None): Collage,
+}
+
+
+def project(parameters, response):
+    """
+    :param parameters: parameters of the call to api.php the response is of
+    :param response: the response, returned as is if there is no record type for it
+    :return: record of the response
+    """
+    record = PROJECTIONS.get((parameters.get('action'), parameters.get('req')))
+    if record is None or not hasattr(response, 'get'):
+        return response
+    return record.project(response)
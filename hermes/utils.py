@@ -1,5 +1,6 @@
 import os
 import subprocess
+from collections.abc import Mapping, Sequence
 
 import yaml
 
@@ -79,10 +80,10 @@ def check_pid(pid):
 
 
 def load_config(config_file):
-    """Utility function to load the configuration file for Hermes and convert all dictionaries
-    inside the config file to DotDict objects instead"""
+    """Utility function to load the configuration file for Hermes, with dot notation on
+    all dictionaries inside the config file through a DotView"""
     config = yaml.safe_load(open(config_file))
-    return convert(config)
+    return view(config)
 
 
 def convert(node):
@@ -98,6 +99,99 @@ def convert(node):
     return node
 
 
+def view(node):
+    """Wraps the node in a DotView or ListView if it is a dict or a list that holds
+    other containers, leaving everything else (including lists of plain values) as is"""
+    if isinstance(node, dict):
+        return DotView(node)
+    if isinstance(node, list) and any(isinstance(elem, (dict, list)) for elem in node):
+        return ListView(node)
+    return node
+
+
+class DotView(Mapping):
+    """
+    Read only view with the same dot notation as DotDict over a parsed dict, without
+    copying it. Nested dicts and lists are only wrapped once they are accessed.
+    """
+    __slots__ = ('_data', '_children')
+
+    def __init__(self, data):
+        self._data = data
+        self._children = None
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if not isinstance(value, (dict, list)):
+            return value
+        if self._children is None:
+            self._children = {}
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = view(value)
+        return child
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            return None
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'DotView({!r})'.format(self._data)
+
+    def __reduce__(self):
+        return DotView, (self._data,)
+
+
+class ListView(Sequence):
+    """Read only view over a parsed list, wrapping its elements once they are read"""
+    __slots__ = ('_data', '_children')
+
+    def __init__(self, data):
+        self._data = data
+        self._children = {}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._data)))]
+        value = self._data[index]
+        if not isinstance(value, (dict, list)):
+            return value
+        index = index % len(self._data)
+        child = self._children.get(index)
+        if child is None:
+            child = self._children[index] = view(value)
+        return child
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, ListView):
+            return self._data == other._data
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'ListView({!r})'.format(self._data)
+
+    def __reduce__(self):
+        return ListView, (self._data,)
+
+
 class DotDict(dict):
     """Utility class that allows for dot notation on dictionaries"""
     __getattr__ = dict.get
@@ -0,0 +1,106 @@
+"""
+Warm-up of the identity map and user cache after the bot connects, so that the first
+authenticated commands after a restart do not all have to wait on the site at once.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .identity import get_identity
+
+LOGGER = logging.getLogger('hermes')
+
+
+class CacheWarmer(object):
+    """
+    Asks the server WHO is in the channels that people most likely run authenticated
+    commands in, and fetches the users behind the vhosts it gets back one at a time at a
+    throttled rate, at low priority so that it never gets in the way of real lookups.
+
+    The config is the warmup section of config.yml, where channels defaults to the
+    channels with a minimum level and those of the interviews and FLS:
+
+        warmup:
+          enabled: true
+          channels:
+            - staff
+          delay: 30
+          interval: 2
+    """
+    DELAY = 30
+    INTERVAL = 2
+    # how long to wait for the server to answer the WHOs
+    WHO_TIMEOUT = 60
+
+    def __init__(self, bot, config):
+        self.bot = bot
+        self.channels = config.get('channels') or default_channels(bot.config)
+        self.delay = config.get('delay', self.DELAY)
+        self.interval = config.get('interval', self.INTERVAL)
+        self.pending = deque()
+        self.seen = set()
+        self.who_pending = 0
+        self.warmed = 0
+        self._handlers = False
+
+    def start(self, connection):
+        """
+        Starts the warm-up once the bot has had delay seconds to join its channels
+        """
+        if not self._handlers:
+            connection.add_global_handler('whoreply', self._on_whoreply)
+            connection.add_global_handler('endofwho', self._on_endofwho)
+            self._handlers = True
+        self.bot.reactor.scheduler.execute_after(
+            self.delay, lambda: self._who(connection))
+
+    def _who(self, connection):
+        if not connection.is_connected():
+            return
+        self.seen.clear()
+        self.who_pending = len(self.channels)
+        for channel in self.channels:
+            connection.who('#' + channel)
+        self.bot.module_runner.spawn(self._warm)
+
+    def _on_whoreply(self, connection, event):
+        # <channel> <user> <host> <server> <nick> <flags> :<hops> <real name>
+        host, nick = event.arguments[2], event.arguments[4]
+        if host.lower() in self.seen or not host.endswith(self.bot.config.site.tld):
+            return
+        self.seen.add(host.lower())
+        self.pending.append((host, nick))
+
+    def _on_endofwho(self, connection, event):
+        self.who_pending -= 1
+
+    async def _warm(self):
+        deadline = time.monotonic() + self.WHO_TIMEOUT
+        while True:
+            if len(self.pending) > 0:
+                host, nick = self.pending.popleft()
+                if self.bot.identities.get(host) is not None:
+                    continue
+                if await get_identity(self.bot, host, nick, self.bot.api.LOW):
+                    self.warmed += 1
+            elif self.who_pending <= 0 or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(self.interval)
+        LOGGER.info("-> Warmed up {} users".format(self.warmed))
+
+
+def default_channels(config):
+    """
+    :return: the channels that have a minimum level, plus the interview and FLS ones
+    """
+    channels = []
+    for name, channel in (config.irc.get('channels') or {}).items():
+        if 'min_level' in channel:
+            channels.append(name)
+    if 'interview' in config:
+        channels.append(config.interview.main_channel)
+        channels.extend(config.interview.channels or [])
+    if 'fls' in config and 'channel' in config.fls:
+        channels.append(config.fls.channel)
+    return [channel for channel in channels if channel]
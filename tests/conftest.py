@@ -0,0 +1,24 @@
+import asyncio
+
+import pytest
+
+
+class FakeAPI(object):
+    """GazelleAPI that answers every get_user with user, and records the calls"""
+    HIGH = 'high'
+    LOW = 'low'
+
+    def __init__(self):
+        # the user to answer with, or a function of the username that makes it
+        self.user = None
+        self.calls = []
+
+    async def get_user(self, username, fresh=False, priority=None, timeout=None):
+        self.calls.append((username, priority))
+        await asyncio.sleep(0)
+        return self.user(username) if callable(self.user) else self.user
+
+
+@pytest.fixture
+def api():
+    return FakeAPI()
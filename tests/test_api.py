@@ -0,0 +1,283 @@
+import asyncio
+import pickle
+
+import httpx
+
+from hermes.api import HIGH, LOW, NOT_FOUND, ApiLimiter, CircuitBreaker, GazelleAPI
+from hermes.cache import Cache
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, params):
+        self.params = params
+
+    def json(self):
+        if self.params.get('user_id') == 404:
+            return {'status': 'failure', 'error': 'bad id parameter'}
+        return {'status': 200, 'response': {'ID': self.params.get('user_id'),
+                                            'Avatar': 'https://example.com/a.png'}}
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.calls = []
+
+    async def get(self, url, params):
+        self.calls.append(params)
+        return FakeResponse(params)
+
+
+def make_api(ttls=None):
+    api = GazelleAPI('https://example.com', 'id', 'key', Cache(),
+                     {'cache_ttl': ttls, 'retries': 2,
+                      'rate_limit': {'rate': 100, 'per': 1}})
+    api.BACKOFF = 0
+    api.client = FakeClient()
+    return api
+
+
+def test_read_through():
+    api = make_api()
+    first = asyncio.run(api.get_user(1))
+    assert asyncio.run(api.get_user(1)) == first
+    assert asyncio.run(api._get({'user_id': '1', 'action': 'user'})) == first
+    assert len(api.client.calls) == 1
+
+    asyncio.run(api.get_user(2))
+    assert len(api.client.calls) == 2
+
+
+def test_fresh():
+    api = make_api()
+    asyncio.run(api.get_user(1))
+    asyncio.run(api.get_user(1, fresh=True))
+    assert len(api.client.calls) == 2
+    asyncio.run(api.get_user(1))
+    assert len(api.client.calls) == 2
+
+
+def test_regions():
+    api = make_api({'torrent': 60})
+    asyncio.run(api.get_user(1))
+    asyncio.run(api.get_torrent(1))
+    asyncio.run(api.get_torrent_group(1))
+    assert [len(api.cache.storage[region]) for region in
+            ('users', 'torrents', 'groups')] == [1, 1, 1]
+    entry = next(iter(api.cache.storage['torrents'].values()))
+    assert 55 < entry.remaining() <= 60
+
+    api.cache.clear(region='users')
+    asyncio.run(api.get_user(1))
+    asyncio.run(api.get_torrent(1))
+    assert len(api.client.calls) == 4
+
+
+def test_no_ttl():
+    api = make_api({'user': 0})
+    asyncio.run(api.get_user(1))
+    asyncio.run(api.get_user(1))
+    assert len(api.client.calls) == 2
+
+
+class SlowClient(FakeClient):
+    async def get(self, url, params):
+        self.calls.append(params)
+        await asyncio.sleep(0.01)
+        return FakeResponse(params)
+
+
+def test_coalesce():
+    api = make_api({'user': 0})
+    api.client = SlowClient()
+
+    async def lookups():
+        return await asyncio.gather(api.get_user(1), api.get_user(1), api.get_user(2))
+
+    first, second, other = asyncio.run(lookups())
+    assert first is second
+    assert other != first
+    assert len(api.client.calls) == 2
+    assert api.inflight == {}
+
+
+def test_coalesce_cancelled_caller():
+    api = make_api()
+    api.client = SlowClient()
+
+    async def lookups():
+        cancelled = asyncio.ensure_future(api.get_user(1))
+        waiting = asyncio.ensure_future(api.get_user(1))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await waiting
+
+    assert asyncio.run(lookups()) is not None
+    assert len(api.client.calls) == 1
+
+
+class FailingClient(FakeClient):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    async def get(self, url, params):
+        self.calls.append(params)
+        if len(self.calls) <= self.failures:
+            raise httpx.ConnectError('connection refused')
+        return FakeResponse(params)
+
+
+def test_retry():
+    api = make_api()
+    api.client = FailingClient(2)
+    assert asyncio.run(api.get_user(1)) is not None
+    assert len(api.client.calls) == 3
+    assert api.breaker.failures == 0
+
+
+def test_breaker_serves_stale():
+    api = make_api()
+    user = asyncio.run(api.get_user(1))
+    for entry in api.cache.storage['users'].values():
+        entry.expiry = 0
+    api.breaker = CircuitBreaker(failures=1, reset=60)
+    api.client = FailingClient(100)
+
+    assert asyncio.run(api.get_user(2)) is None
+    assert len(api.client.calls) == 3
+    assert api.breaker.state == CircuitBreaker.OPEN
+    assert asyncio.run(api.get_user(2)) is None
+    assert asyncio.run(api.get_user(1)) == user
+    assert len(api.client.calls) == 3
+
+
+class BrokenClient(FakeClient):
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    async def get(self, url, params):
+        self.calls.append(params)
+        await asyncio.sleep(0.01)
+        raise self.error
+
+
+def test_unexpected_errors():
+    for error in (httpx.DecodingError('bad gzip'), ValueError('bad url')):
+        api = make_api()
+        api.client = BrokenClient(error)
+
+        async def lookups():
+            return await asyncio.gather(api.get_user(1), api.get_user(1))
+
+        assert asyncio.run(lookups()) == [None, None]
+        assert len(api.client.calls) == 1
+        assert api.breaker.failures == 1
+        assert api.inflight == {}
+
+
+def test_breaker_half_open():
+    breaker = CircuitBreaker(failures=2, reset=0)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_shed_probe():
+    api = make_api()
+    api.breaker = CircuitBreaker(failures=1, reset=0)
+    api.breaker.failure()
+    # low priority calls do not get to be the probe
+    assert asyncio.run(api.get_user(1)) is None
+    assert api.breaker.state == CircuitBreaker.OPEN
+
+    async def shed(lane):
+        return False
+    api.limiter.acquire = shed
+    assert asyncio.run(api.get_user(1, priority=HIGH)) is None
+    assert api.breaker.state == CircuitBreaker.OPEN
+    assert api.client.calls == []
+
+    del api.limiter.acquire
+    assert asyncio.run(api.get_user(1, priority=HIGH)) is not None
+    assert api.breaker.state == CircuitBreaker.CLOSED
+    assert asyncio.run(api.get_user(2)) is not None
+
+
+def test_limiter_priority():
+    limiter = ApiLimiter(rate=2, per=1, reserve=1, defer=0.2)
+
+    async def calls():
+        assert await limiter.acquire([LOW])
+        # the last token is held back for high priority calls
+        assert not await limiter.acquire([LOW])
+        assert await limiter.acquire([HIGH])
+        return await asyncio.gather(limiter.acquire([HIGH]), limiter.acquire([LOW]))
+
+    assert asyncio.run(calls()) == [True, False]
+    assert limiter.shed == 2
+    assert limiter.metrics()['waiting'] == {HIGH: 0, LOW: 0}
+
+
+def test_shed_call():
+    api = make_api()
+    api.limiter = ApiLimiter(rate=1, per=60, reserve=1, defer=0)
+    assert asyncio.run(api.get_user(1)) is None
+    assert asyncio.run(api.get_user(1, priority=HIGH)) is not None
+    assert api.metrics()['limiter']['shed'] == 1
+
+
+class HangingClient(FakeClient):
+    async def get(self, url, params):
+        self.calls.append(params)
+        await asyncio.Event().wait()
+
+
+def test_timeout():
+    api = make_api()
+    user = asyncio.run(api.get_user(1))
+    api.client = HangingClient()
+
+    async def lookups():
+        # the caller gives up on the site, but the request carries on for the next
+        hung = await api.get_user(2, priority=HIGH, timeout=0.05)
+        assert len(api.inflight) == 1
+        stale = await api.get_user(1, fresh=True, priority=HIGH, timeout=0.05)
+        return hung, stale
+
+    assert asyncio.run(lookups()) == (None, user)
+    assert len(api.client.calls) == 2
+
+
+class TimeoutClient(FakeClient):
+    async def get(self, url, params):
+        self.calls.append(params)
+        raise httpx.ReadTimeout('timed out')
+
+
+def test_negative_cache():
+    api = make_api()
+    assert asyncio.run(api.get_user(404)) is None
+    assert asyncio.run(api.get_user(404)) is None
+    assert len(api.client.calls) == 1
+    assert asyncio.run(api.get_user(404, fresh=True)) is None
+    assert len(api.client.calls) == 2
+
+
+def test_errors_not_cached():
+    api = make_api()
+    api.client = TimeoutClient()
+    assert asyncio.run(api.get_user(1)) is None
+    assert len(api.cache) == 0
+
+
+def test_not_found_pickle():
+    assert pickle.loads(pickle.dumps(NOT_FOUND)) is NOT_FOUND
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+from unittest.mock import MagicMock
+
+import irc.client
+import pytest
+
+from hermes.asyncio_runner import LoopRunner
+from hermes.loader import _parse_callable
+from hermes.module import command, inline, latest_wins, priority, time_limit
+from hermes.utils import convert
+
+
+@pytest.fixture
+def runner():
+    loop = asyncio.new_event_loop()
+    bot = MagicMock()
+    bot.config = convert({})
+    runner = LoopRunner(bot, loop)
+    runner.start()
+    yield runner
+    runner.stop()
+    loop.close()
+
+
+def make_event(msg='!test'):
+    return irc.client.Event(
+        type='pubmsg',
+        source=irc.client.NickMask('nick!userid@name.User.example.test'),
+        target='#channel',
+        arguments=[msg]
+    )
+
+
+async def drain(runner):
+    while len(runner._tasks) > 0:
+        await asyncio.gather(*runner._tasks, return_exceptions=True)
+
+
+def run(runner, handlers, event=None):
+    event = event or make_event()
+
+    async def go():
+        runner.queue(MagicMock(), event, handlers)
+        await drain(runner)
+    runner.loop.run_until_complete(go())
+
+
+def test_sync_handler_runs_in_executor(runner):
+    threads = []
+
+    @command('test')
+    def handler(bot, connection, event):
+        threads.append(threading.current_thread())
+
+    run(runner, [('test', _parse_callable(handler), ())])
+    assert threads[0] is not threading.current_thread()
+
+
+def test_inline_handler_runs_on_loop(runner):
+    threads = []
+
+    @command('test')
+    @inline()
+    def handler(bot, connection, event):
+        threads.append(threading.current_thread())
+
+    run(runner, [('test', _parse_callable(handler), ())])
+    assert threads == [threading.current_thread()]
+
+
+def test_async_handler_gets_args(runner):
+    calls = []
+
+    @command('test')
+    async def handler(bot, connection, event, match):
+        calls.append(match)
+
+    run(runner, [('test', _parse_callable(handler), ('match',))])
+    assert calls == ['match']
+
+
+def test_time_limit(runner):
+    calls = []
+
+    @command('test')
+    @time_limit(0.01)
+    async def handler(bot, connection, event):
+        await asyncio.sleep(1)
+        calls.append(event)
+
+    run(runner, [('test', _parse_callable(handler), ())])
+    assert calls == []
+
+
+def test_latest_wins(runner):
+    calls = []
+
+    @command('test')
+    @latest_wins()
+    async def handler(bot, connection, event, delay):
+        await asyncio.sleep(delay)
+        calls.append(delay)
+
+    handler = _parse_callable(handler)
+
+    async def go():
+        runner.queue(MagicMock(), make_event(), [('test', handler, (0.05,))])
+        runner.queue(MagicMock(), make_event(), [('test', handler, (0.01,))])
+        await drain(runner)
+    runner.loop.run_until_complete(go())
+    assert calls == [0.01]
+    assert runner._latest == {}
+
+
+def make_tracker(running, order):
+    async def handler(bot, connection, event, name):
+        running[name] = running.get(name, 0) + 1
+        order.append((name, running[name]))
+        await asyncio.sleep(0.01)
+        running[name] -= 1
+    return _parse_callable(command('test')(handler))
+
+
+def test_module_concurrency_and_fairness(runner):
+    runner.max_tasks = 3
+    runner.module_config = convert({'busy': {'concurrency': 2}})
+    running = {}
+    order = []
+    handler = make_tracker(running, order)
+    handlers = [('busy', handler, ('busy',))] * 10 + [('quiet', handler, ('quiet',))]
+    run(runner, handlers)
+    assert max(count for name, count in order if name == 'busy') == 2
+    # the quiet module gets a turn before the busy module's queue is worked through
+    assert [name for name, _ in order].index('quiet') < 3
+    assert runner.metrics()['busy']['started'] == 10
+
+
+def test_queue_overflow_drops_oldest(runner):
+    runner.max_tasks = 1
+    runner.queue_size = 2
+    running = {}
+    order = []
+    handler = make_tracker(running, order)
+    run(runner, [('test', handler, (str(i),)) for i in range(5)])
+    assert [name for name, _ in order] == ['0', '3', '4']
+    assert runner.dropped['test'] == 2
+
+
+def test_priority_skips_queue(runner):
+    runner.max_tasks = 1
+    running = {}
+    order = []
+    handler = make_tracker(running, order)
+
+    @command('urgent')
+    @priority()
+    async def urgent(bot, connection, event, name):
+        order.append((name, 1))
+
+    run(runner, [('test', handler, ('a',)), ('test', handler, ('b',)),
+                 ('auth', _parse_callable(urgent), ('urgent',))])
+    # started while 'a' is still using up the only slot, ahead of the queued 'b'
+    assert [name for name, _ in order] == ['a', 'urgent', 'b']
+
+
+def test_spawn(runner):
+    done = []
+
+    async def background(value):
+        await asyncio.sleep(0)
+        done.append(value)
+
+    async def go():
+        runner.spawn(background, 1)
+        await drain(runner)
+    runner.loop.run_until_complete(go())
+    assert done == [1]
+    assert runner.metrics() == {}
@@ -0,0 +1,238 @@
+import pickle
+import threading
+import time
+from datetime import datetime, timedelta
+
+from hermes.cache import Cache, CacheObject
+
+
+def test_store_get():
+    cache = Cache()
+    cache.store('a', 1)
+    assert cache['a'] == 1
+    assert cache.get('b') is None
+    cache.store('b', 2, timedelta(seconds=-1))
+    assert cache.get('b') is None
+    assert 'b' not in cache
+
+
+def test_lru_max_entries():
+    cache = Cache(max_entries=3)
+    for key in 'abc':
+        cache.store(key, key)
+    assert cache.get('a') == 'a'
+    cache.store('d', 'd')
+    assert cache.keys() == ['c', 'a', 'd']
+    assert cache.get('b') is None
+
+
+def test_lru_max_bytes():
+    cache = Cache()
+    cache.store('a', 'x' * 100)
+    size = cache.bytes
+    cache.regions['default'].max_bytes = size * 2
+    cache.store('b', 'x' * 100)
+    cache.store('c', 'x' * 100)
+    assert cache.keys() == ['b', 'c']
+    assert cache.bytes == size * 2
+    cache.clear('b')
+    assert cache.bytes == size
+
+
+def test_load_storage():
+    now = time.monotonic()
+    cache = Cache({
+        'old': CacheObject('old', now - 1),
+        'a': CacheObject('a', now + 60),
+        'b': CacheObject('b', now + 60),
+    }, max_entries=1)
+    assert cache.keys() == ['b']
+    assert cache.bytes > 0
+
+
+class LegacyCacheObject(object):
+    def __init__(self, value, expiry):
+        self.value = value
+        self.expiry = expiry
+
+
+def test_pickle_legacy():
+    legacy = pickle.dumps(LegacyCacheObject('value', datetime.max), 0)
+    legacy = legacy.replace(b'LegacyCacheObject', b'CacheObject')
+    legacy = legacy.replace(b'tests.test_cache', b'hermes.cache')
+    entry = pickle.loads(legacy)
+    assert isinstance(entry, CacheObject)
+    assert (entry.value, entry.size) == ('value', 0)
+    assert entry.remaining() > 365 * 86400
+
+    legacy = pickle.dumps(LegacyCacheObject('value', datetime.now() + timedelta(1)), 0)
+    legacy = legacy.replace(b'LegacyCacheObject', b'CacheObject')
+    legacy = legacy.replace(b'tests.test_cache', b'hermes.cache')
+    assert 86000 < pickle.loads(legacy).remaining() < 86400
+
+
+def test_pickle_expiry():
+    entry = pickle.loads(pickle.dumps(CacheObject('value', time.monotonic() + 60, 5)))
+    assert (entry.value, entry.size) == ('value', 5)
+    assert 59 < entry.remaining() <= 60
+
+
+def test_expire():
+    cache = Cache()
+    cache.store('a', 1, -1)
+    cache.store('b', 2, -1)
+    cache.store('c', 3, 60)
+    cache.store('b', 2, 60)
+    cache.clear('a')
+    cache.store('d', 4, -1)
+    assert cache.expire() == 1
+    assert cache.keys() == ['c', 'b']
+    assert cache.expire() == 0
+
+
+def test_metrics():
+    cache = Cache(max_entries=2)
+    cache.store('user_a', 'a')
+    cache.store('user_b', 'b', -1)
+    cache.get('user_a')
+    cache.get('user_b')
+    cache.get_entry('user_c')
+    cache.store('api.user_1', 1)
+    cache.store('api.user_2', 2)
+
+    metrics = cache.metrics()
+    assert metrics['user'] == {'entries': 0, 'bytes': 0, 'hits': 1, 'misses': 2,
+                               'expired': 1, 'evicted': 1, 'loaded': 0}
+    assert metrics['api.user']['entries'] == 2
+    assert metrics['api.user']['bytes'] == cache.bytes
+    assert metrics['*']['entries'] == len(cache)
+    assert metrics['*']['hits'] == 1
+
+    cache.clear()
+    assert cache.metrics()['*']['bytes'] == 0
+
+
+def test_metrics_empty():
+    # nothing is counted before the first lookup, such as right after a restart
+    assert Cache().metrics() == {'*': {'entries': 0, 'bytes': 0, 'hits': 0,
+                                       'misses': 0, 'expired': 0, 'evicted': 0,
+                                       'loaded': 0}}
+
+
+def test_regions():
+    cache = Cache(regions={'users': {'ttl': 60, 'max_entries': 2}})
+    assert cache.regions['users'].ttl == timedelta(seconds=60)
+    assert cache.regions['torrents'].max_entries == Cache.MAX_ENTRIES
+    for key in 'abc':
+        cache.store(key, key, region='users')
+    cache.store('a', 'default')
+    assert cache.keys() == ['a']
+    assert list(cache.storage['users']) == ['b', 'c']
+    assert cache.get('b', 'users') == 'b'
+    assert 55 < cache.get_entry('c', 'users').remaining() <= 60
+    assert cache.metrics()['users']['evicted'] == 1
+
+
+def test_regions_partial_config():
+    cache = Cache(regions={'users': {'max_entries': 5}})
+    assert cache.regions['users'].max_entries == 5
+    assert cache.regions['users'].ttl == timedelta(seconds=300)
+
+
+def test_clear_region():
+    cache = Cache()
+    cache.store('a', 1, -1, region='users')
+    cache.store('b', 2, region='users')
+    cache.store('c', 3, region='torrents')
+    cache.clear(region='users')
+    assert len(cache) == 1
+    assert cache.get('b', 'users') is None
+    assert cache.metrics()['users']['entries'] == 0
+    # the expiry of the entry of the old generation does not touch the new one
+    cache.store('a', 1, 60, region='users')
+    assert cache.expire() == 0
+    assert cache.get('a', 'users') == 1
+
+
+def test_load_regions():
+    now = time.monotonic()
+    cache = Cache({
+        'users': {'a': CacheObject('a', now + 60)},
+        'old': {'b': CacheObject('b', now + 60)},
+    })
+    assert cache.get('a', 'users') == 'a'
+    assert cache.get('b', 'old') == 'b'
+    assert cache.storage['users'] is cache.regions['users'].entries
+
+
+def test_disk(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = Cache(max_entries=1, path=path)
+    cache.store('a', 1)
+    cache.store('b', 2)
+    cache.store('c', 3, region='users')
+    cache.store('d', 4, region='users')
+    # a was evicted from memory, and is read back from disk (or the pending writes)
+    assert cache.keys() == ['b']
+    assert cache.get('a') == 1
+    assert cache.keys() == ['a']
+    cache.clear('b')
+    cache.clear(region='users')
+    cache.close()
+
+    cache = Cache(path=path)
+    assert len(cache) == 0
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c', 'users') is None
+    assert cache.regions['users'].generation == 1
+    assert cache.metrics()['a']['loaded'] == 1
+    cache.close()
+
+
+def test_disk_pending(tmp_path):
+    cache = Cache(max_entries=1, path=str(tmp_path / 'cache.db'))
+    release = threading.Event()
+    execute = cache.disk._execute
+
+    def blocked(connection, op):
+        release.wait()
+        execute(connection, op)
+    cache.disk._execute = blocked
+
+    cache.store('a', 1)
+    cache.store('b', 2)
+    assert ('default', 'a') in cache.disk.pending
+    assert cache.get('a') == 1
+    cache.clear('a')
+    assert cache.get('a') is None
+    release.set()
+    cache.close()
+    assert cache.disk.pending == {}
+    assert cache.disk.metrics()['errors'] == 0
+
+
+def test_disk_migrate(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    Cache({'a': CacheObject('a', time.monotonic() + 60)}, path=path).close()
+    cache = Cache(path=path)
+    assert cache.get('a') == 'a'
+    cache.close()
+
+
+def test_legacy_into_region(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    now = time.monotonic()
+    cache = Cache({'user_a': CacheObject('a', now + 60)}, path=path)
+    cache.close()
+
+    cache = Cache(path=path)
+    assert cache.legacy
+    assert cache.get_entry('user_a', 'users').value == 'a'
+    assert 'user_a' not in cache
+    assert list(cache.storage['users']) == ['user_a']
+    cache.close()
+    cache = Cache(path=path)
+    assert not cache.legacy
+    assert cache.get('user_a', 'users') == 'a'
+    cache.close()
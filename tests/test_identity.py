@@ -0,0 +1,67 @@
+import asyncio
+from unittest.mock import MagicMock
+
+from hermes.identity import IdentityMap, authorize, get_identity
+from hermes.records import User
+from hermes.utils import view
+
+HOST = 'someone.PowerUser.example.test'
+
+
+def make_bot(api):
+    bot = MagicMock()
+    bot.config = view({'site': {'tld': 'example.test'}})
+    bot.identities = IdentityMap()
+    bot.api = api
+    return bot
+
+
+def make_user(level=200, secondary=()):
+    return User(1, 'someone', 'Power User', 3, list(secondary), level, '1', '0', 'key')
+
+
+def test_identity_map():
+    identities = IdentityMap()
+    identities.add(HOST, make_user(), 'nick')
+    assert identities.get(HOST.upper()).Level == 200
+    identities.forget('NICK')
+    assert identities.get(HOST) is None
+
+    identities.add(HOST, make_user())
+    identities.forget('nick', HOST)
+    assert len(identities) == 0
+
+    identities = IdentityMap(ttl=0)
+    identities.add(HOST, make_user(), 'nick')
+    assert identities.get(HOST) is None
+
+
+def test_get_identity(api):
+    api.user = make_user()
+    bot = make_bot(api)
+    assert asyncio.run(get_identity(bot, 'some.other.host.com')) is None
+    assert asyncio.run(get_identity(bot, HOST)).Username == 'someone'
+    assert asyncio.run(get_identity(bot, HOST)).Username == 'someone'
+    assert len(api.calls) == 1
+
+
+def test_authorize(api):
+    connection = MagicMock()
+    bot = make_bot(api)
+    bot.identities.add(HOST, make_user(secondary=[30]), 'nick')
+
+    def run(**kwargs):
+        return asyncio.run(authorize(bot, connection, HOST, 'nick', True, 'test',
+                                     **kwargs))
+
+    assert run(min_level=100)
+    assert run(min_level=800, class_id=30)
+    assert not run(min_level=800, class_id=31)
+    connection.notice.assert_called_once_with(
+        'nick', 'You are not authorized to do this command!')
+    assert api.calls == []
+
+    bot.identities.forget('nick')
+    assert not run(min_level=100)
+    connection.notice.assert_called_with(
+        'nick', 'You must be authed through the bot to test.')
@@ -0,0 +1,129 @@
+import asyncio
+import socket
+import threading
+import time
+from datetime import timedelta
+
+import pytest
+
+from hermes.irc import AioReactor, IRCBot, LoopScheduler
+
+
+class FakeServer(object):
+    """IRC server that records the lines it gets, and can drop its clients"""
+    def __init__(self):
+        self.lines = []
+        self.writers = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def _client(self, reader, writer):
+        self.writers.append(writer)
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            self.lines.append(line.decode().rstrip('\r\n'))
+
+    async def wait_for(self, line, timeout=2):
+        deadline = time.monotonic() + timeout
+        while line not in self.lines:
+            assert time.monotonic() < deadline, self.lines
+            await asyncio.sleep(0.01)
+
+    async def drop(self):
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+
+    async def stop(self):
+        await self.drop()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class Recon(object):
+    def __init__(self):
+        self.runs = 0
+
+    def run(self, bot):
+        self.runs += 1
+
+
+async def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_loop_scheduler(loop):
+    scheduler = LoopScheduler(loop)
+    calls = []
+    scheduler.execute_every(timedelta(seconds=0.05), lambda: calls.append('every'))
+    scheduler.execute_after(0.02, lambda: calls.append('after'))
+    scheduler.execute_at(time.time() - 1, lambda: calls.append('at'))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert calls == ['at']
+    loop.run_until_complete(asyncio.sleep(0.03))
+    assert calls == ['at', 'after']
+    loop.run_until_complete(asyncio.sleep(0.14))
+    assert 2 <= calls.count('every') <= 3
+
+
+def test_send_raw_from_thread(loop):
+    reactor = AioReactor(loop)
+    server = loop.run_until_complete(FakeServer().start())
+    connection = reactor.server()
+    loop.run_until_complete(connection.connect('127.0.0.1', server.port, 'hermes'))
+    loop.run_until_complete(server.wait_for('NICK hermes'))
+
+    thread = threading.Thread(target=connection.send_raw, args=('PRIVMSG #a :hi',))
+    thread.start()
+    thread.join()
+    loop.run_until_complete(server.wait_for('PRIVMSG #a :hi'))
+    connection.disconnect()
+    loop.run_until_complete(server.stop())
+
+
+def test_disconnect_reconnect():
+    recon = Recon()
+    bot = IRCBot([('127.0.0.1', 1)], 'hermes', 'hermes', recon=recon,
+                 use_asyncio=True)
+    loop = bot.reactor.loop
+    server = loop.run_until_complete(FakeServer().start())
+    bot.connect('127.0.0.1', server.port, 'hermes')
+    loop.run_until_complete(server.wait_for('NICK hermes'))
+    assert bot.connection.is_connected()
+
+    # the server going away hands over to the reconnect strategy
+    loop.run_until_complete(server.drop())
+    loop.run_until_complete(wait_until(lambda: recon.runs == 1))
+    assert not bot.connection.is_connected()
+
+    # and so does failing to connect
+    with socket.socket() as closed:
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+    bot.connect('127.0.0.1', port, 'hermes')
+    loop.run_until_complete(wait_until(lambda: recon.runs == 2))
+
+    # after which it connects again
+    bot.connect('127.0.0.1', server.port, 'hermes')
+    loop.run_until_complete(wait_until(
+        lambda: server.lines.count('NICK hermes') == 2))
+    assert bot.connection.is_connected()
+    bot.connection.disconnect()
+    loop.run_until_complete(server.stop())
+    loop.close()
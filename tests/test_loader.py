@@ -0,0 +1,101 @@
+import re
+import types
+
+from hermes.loader import RuleMatcher, build_dispatch_table, parse_module
+from hermes.module import command, disabled, event, rule
+
+
+def make_module(**funcs):
+    mod = types.ModuleType('testmod')
+    for name, func in funcs.items():
+        setattr(mod, name, func)
+    mod.__callables__ = parse_module(mod)
+    return mod
+
+
+@event('pubmsg', 'privmsg')
+@command('user', 'u')
+def show_user(bot, connection, event):
+    pass
+
+
+@command('secret')
+def secret(bot, connection, event):
+    pass
+
+
+@disabled()
+@command('off')
+def turned_off(bot, connection, event):
+    pass
+
+
+@rule(r'^[!\.][a-z]+')
+def trigger(bot, connection, event, match):
+    pass
+
+
+MODULES = {'test': make_module(show_user=show_user, secret=secret,
+                               turned_off=turned_off, trigger=trigger)}
+
+
+def test_dispatch_commands():
+    table = build_dispatch_table(MODULES)
+    for cmd in ('.user', '!user', '.u', '!u'):
+        assert table.get_commands('pubmsg', cmd) == [('test', show_user)]
+    assert table.get_commands('privmsg', 'user') == [('test', show_user)]
+    assert table.get_commands('pubmsg', 'user') == []
+    assert table.get_commands('pubmsg', '!secret') == [('test', secret)]
+    assert table.get_commands('privmsg', '!secret') == []
+    assert table.get_commands('pubmsg', 'hello') == []
+
+
+def test_dispatch_rules():
+    table = build_dispatch_table(MODULES)
+    matches = table.match_rules('pubmsg', '!hello there')
+    assert [(name, func) for name, func, _ in matches] == [('test', trigger)]
+    assert matches[0][2].group(0) == '!hello'
+    assert table.match_rules('pubmsg', 'hello there') == []
+    assert table.match_rules('privmsg', '!hello there') == []
+
+
+def test_dispatch_disabled():
+    table = build_dispatch_table(MODULES)
+    assert table.get_commands('pubmsg', '!off') == []
+
+
+URL_RULES = [
+    (r"https:\/\/orpheus\.network\/forums\.php\?[a-zA-Z0-9=&]*threadid=([0-9]+)",
+     re.IGNORECASE),
+    (r"https:\/\/orpheus\.network\/torrents\.php\?[a-zA-Z0-9=&]*torrentid=([0-9]+)", 0),
+    (r"https:\/\/orpheus\.network\/torrents\.php[a-zA-Z0-9=&\?]*[\?&]id=([0-9]+)$", 0),
+    (r"http(?:s?):\/\/(?:www\.)?youtu(?:be\.com\/watch\?v=|\.be\/)([\w\-\_]*)",
+     re.IGNORECASE),
+    (r'^[!\.][a-zA-Z0-9]+', 0),
+    (r'(\d+)x(\d+)', 0),
+]
+
+MESSAGES = [
+    'hey, anyone around?',
+    '!rules',
+    '.user somebody',
+    'see https://orpheus.network/forums.php?action=viewthread&threadid=12',
+    'HTTPS://ORPHEUS.NETWORK/FORUMS.PHP?threadid=99 is the thread',
+    'https://orpheus.network/torrents.php?id=5&torrentid=77',
+    'https://orpheus.network/torrents.php?id=5',
+    'https://YOUTU.be/abc_123 watch this',
+    'resolution is 1920x1080',
+    '',
+]
+
+
+def test_rule_matcher_same_as_search():
+    entries = [('test', None, re.compile(*rule)) for rule in URL_RULES]
+    matcher = RuleMatcher(entries)
+    assert len(matcher.unfiltered) == 1
+    for msg in MESSAGES:
+        expected = [(rule.pattern, match.groups()) for _, _, rule in entries
+                    for match in [rule.search(msg)] if match]
+        result = [(match.re.pattern, match.groups())
+                  for _, _, match in matcher.match(msg)]
+        assert result == expected, msg
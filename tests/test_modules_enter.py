@@ -0,0 +1,112 @@
+import asyncio
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+import irc.client
+import pytest
+
+from hermes.api import GazelleAPI
+from hermes.cache import Cache
+from hermes.modules import enter
+from hermes.records import User
+from hermes.utils import view
+
+
+class Event(irc.client.Event):
+    @property
+    def args(self):
+        args = self.arguments[0].split()
+        return args[1:] if len(args) > 1 else []
+
+
+def make_user(irckey='key', enabled='1'):
+    return User(1, 'someone', 'Power User', 3, [], 200, enabled, '0', irckey, None, '')
+
+
+@pytest.fixture
+def bot(api):
+    bot = MagicMock()
+    bot.api = api
+    bot.cache = Cache()
+    bot.config = view({
+        'site': {'tld': 'example.test'},
+        'irc': {'channels': {'orpheus': {'name': 'orpheus'}}},
+    })
+    yield bot
+
+
+def run_enter(bot, connection):
+    event = Event(type='privmsg', source=irc.client.NickMask('nick!user@host'),
+                  target='hermes', arguments=['enter #orpheus someone key'])
+
+    async def run():
+        await enter.enter(bot, connection, event)
+        await asyncio.gather(*enter.revalidations)
+    asyncio.run(run())
+
+
+def test_enter_from_site(bot, api):
+    api.user = make_user()
+    connection = MagicMock()
+    run_enter(bot, connection)
+    connection.send_raw.assert_any_call('SAJOIN nick #orpheus')
+    assert len(api.calls) == 1
+    assert bot.cache.get('user_someone', 'users') == make_user()
+
+
+def test_enter_from_cache(bot, api):
+    bot.cache.store('user_someone', make_user(), enter.USER_TTL, 'users')
+    api.user = make_user()
+    connection = MagicMock()
+    run_enter(bot, connection)
+    connection.send_raw.assert_any_call('SAJOIN nick #orpheus')
+    connection.kick.assert_not_called()
+    # checked in the background
+    assert len(api.calls) == 1
+
+
+def test_enter_revalidation_kicks(bot, api):
+    bot.cache.store('user_someone', make_user(), enter.USER_TTL, 'users')
+    api.user = make_user(enabled='0')
+    connection = MagicMock()
+    run_enter(bot, connection)
+    connection.send_raw.assert_any_call('SAJOIN nick #orpheus')
+    connection.kick.assert_called_once()
+    assert connection.kick.call_args.args[:2] == ('#orpheus', 'nick')
+    # and the vhost no longer vouches for them
+    connection.send_raw.assert_any_call('CHGIDENT nick user')
+    connection.send_raw.assert_called_with('CHGHOST nick host')
+    assert bot.cache.get('user_someone', 'users') is None
+
+
+def test_enter_stale_cache(bot, api):
+    bot.cache.store('user_someone', make_user(), enter.USER_TTL - enter.MAX_STALE * 2,
+                    'users')
+    api.user = make_user(irckey='other')
+    connection = MagicMock()
+    run_enter(bot, connection)
+    connection.send_raw.assert_not_called()
+    connection.privmsg.assert_called_with('nick', 'Invalid Username/IRC Key')
+
+
+class HangingClient(object):
+    async def get(self, url, params):
+        await asyncio.Event().wait()
+
+
+def test_enter_site_hangs(bot, monkeypatch):
+    # the wait on the site leaves enter time to fall back on the cache
+    assert enter.API_TIMEOUT < enter.enter.time_limit
+    monkeypatch.setattr(enter, 'API_TIMEOUT', 0.05)
+    bot.cache.store('user_someone', make_user(), enter.USER_TTL - timedelta(10),
+                    'users')
+    bot.api = GazelleAPI('https://example.test', 'id', 'key', bot.cache)
+    bot.api.client = HangingClient()
+    connection = MagicMock()
+
+    async def run():
+        event = Event(type='privmsg', source=irc.client.NickMask('nick!user@host'),
+                      target='hermes', arguments=['enter #orpheus someone key'])
+        await asyncio.wait_for(enter.enter(bot, connection, event), 1)
+    asyncio.run(run())
+    connection.send_raw.assert_any_call('SAJOIN nick #orpheus')
@@ -0,0 +1,166 @@
+import os
+import pickle
+import threading
+
+from hermes.persist import JournaledDict, JournaledList, PersistentStorage
+
+
+def test_replay(tmp_path):
+    path = str(tmp_path / 'persist.dat')
+    storage = PersistentStorage(path)
+    storage['queue'] = []
+    storage['quotes'] = {'a': 'first'}
+    storage['queue'].append(1)
+    storage['queue'].extend([2, 3])
+    storage['queue'].pop(0)
+    storage['queue'].insert(0, 0)
+    storage['quotes']['b'] = {'nested': 1}
+    storage['quotes']['b']['nested'] = 2
+    del storage['quotes']['a']
+    storage['old'] = 'value'
+    storage.clear('old')
+    storage.close()
+    assert not os.path.isfile(path)
+
+    storage = PersistentStorage(path)
+    assert storage['queue'] == [0, 2, 3]
+    assert storage['quotes'] == {'b': {'nested': 2}}
+    assert 'old' not in storage
+    assert isinstance(storage['queue'], JournaledList)
+    assert isinstance(storage['quotes']['b'], JournaledDict)
+    storage.close()
+
+
+def test_compact(tmp_path):
+    path = str(tmp_path / 'persist.dat')
+    storage = PersistentStorage(path, max_journal=100)
+    storage['queue'] = []
+    assert not storage.sync()
+    storage['queue'].extend(range(100))
+    assert storage.sync()
+    assert storage.journal.size < 100
+    storage['queue'].reverse()
+    storage.close()
+
+    with open(path, 'rb') as f:
+        assert type(pickle.load(f)['queue']) is list
+    storage = PersistentStorage(path)
+    assert storage.epoch == 1
+    assert storage['queue'] == list(reversed(range(100)))
+    storage.close()
+
+
+def test_torn_journal(tmp_path):
+    path = str(tmp_path / 'persist.dat')
+    storage = PersistentStorage(path)
+    storage['queue'] = [1]
+    storage['queue'].append(2)
+    storage.close()
+    with open(path + '.journal.0', 'r+b') as f:
+        f.truncate(os.path.getsize(path + '.journal.0') - 2)
+
+    storage = PersistentStorage(path)
+    assert storage['queue'] == [1]
+    storage['queue'].append(3)
+    storage.close()
+    assert PersistentStorage(path)['queue'] == [1, 3]
+
+
+def test_stale_journal(tmp_path):
+    path = str(tmp_path / 'persist.dat')
+    storage = PersistentStorage(path)
+    storage['queue'] = [1]
+    with open(path + '.journal.0', 'rb') as f:
+        journal = f.read()
+    storage.save()
+    storage.close()
+    # as if the bot crashed between writing the snapshot and resetting the journal
+    with open(path + '.journal.0', 'wb') as f:
+        f.write(journal)
+
+    storage = PersistentStorage(path)
+    assert storage['queue'] == [1]
+    storage.close()
+
+
+def test_legacy_snapshot(tmp_path):
+    path = str(tmp_path / 'persist.dat')
+    with open(path, 'wb') as f:
+        pickle.dump({'quotes': {'a': 'first'}}, f)
+    storage = PersistentStorage(path)
+    assert storage.epoch == 0
+    storage['quotes']['b'] = 'second'
+    storage.close()
+    assert PersistentStorage(path)['quotes'] == {'a': 'first', 'b': 'second'}
+
+
+def test_snapshot(tmp_path):
+    path = str(tmp_path / 'persist.dat')
+    storage = PersistentStorage(path)
+    storage['queue'] = [1]
+    assert storage.save()
+    # changes made while the snapshot is written go into the next segment
+    storage['queue'].append(2)
+    storage.close()
+    assert storage.snapshot is None
+    assert storage.epoch == 1
+    assert sorted(os.listdir(str(tmp_path))) == ['persist.dat', 'persist.dat.journal.1']
+
+    storage = PersistentStorage(path)
+    assert storage['queue'] == [1, 2]
+    storage.save(wait=True)
+    assert storage.epoch == 2
+    storage.close()
+    with open(path, 'rb') as f:
+        assert pickle.load(f)['queue'] == [1, 2]
+        assert pickle.load(f) == 2
+
+
+def test_failed_snapshot(tmp_path):
+    path = str(tmp_path / 'persist.dat')
+    storage = PersistentStorage(path)
+    storage['queue'] = [1]
+    storage['bad'] = lambda: None
+    storage.save(wait=True)
+    assert storage.epoch == 0
+    assert not os.path.isfile(path + '.tmp')
+    storage.clear('bad')
+    storage.close()
+    assert not os.path.isfile(path)
+    assert PersistentStorage(path)['queue'] == [1]
+
+
+def test_closed(tmp_path):
+    path = str(tmp_path / 'persist.dat')
+    storage = PersistentStorage(path, max_journal=0)
+    storage['queue'] = [1]
+    storage.close()
+    # a storage opened on the same files after this one is left alone
+    other = PersistentStorage(path)
+    assert not storage.sync()
+    assert not storage.save()
+    storage.close()
+    assert not os.path.isfile(path)
+    assert sorted(os.listdir(str(tmp_path))) == ['persist.dat.journal.0']
+    assert other['queue'] == [1]
+    other.close()
+
+
+def test_sync_unlocked(tmp_path, monkeypatch):
+    storage = PersistentStorage(str(tmp_path / 'persist.dat'))
+    storage['queue'] = [1]
+    fsync = os.fsync
+
+    def slow_fsync(fd):
+        # changes can be made while the journal is synced
+        thread = threading.Thread(target=storage['queue'].append, args=(2,))
+        thread.start()
+        thread.join(1)
+        assert not thread.is_alive()
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', slow_fsync)
+    assert not storage.sync()
+    monkeypatch.setattr(os, 'fsync', fsync)
+    assert storage.journal.dirty
+    storage.close()
+    assert PersistentStorage(str(tmp_path / 'persist.dat'))['queue'] == [1, 2]
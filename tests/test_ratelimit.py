@@ -0,0 +1,36 @@
+from hermes.ratelimit import RateLimiter, TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(1, 2)
+    now = bucket.updated
+    assert bucket.consume(now=now)
+    assert bucket.consume(now=now)
+    assert not bucket.consume(now=now)
+    assert bucket.wait_time(now=now) == 1
+    assert bucket.consume(now=now + 1)
+    assert not bucket.is_full(now=now + 1)
+    assert bucket.is_full(now=now + 10)
+
+
+def test_rate_limiter_user():
+    limiter = RateLimiter({'user': {'rate': 2, 'per': 60}})
+    assert limiter.allow('user', 'someone.User.example.test', '#channel')
+    assert limiter.allow('quote', 'someone.User.example.test', '#channel')
+    assert not limiter.allow('help', 'someone.User.example.test', '#channel')
+    assert limiter.allow('help', 'other.User.example.test', '#channel')
+    assert limiter.dropped['help'] == 1
+
+
+def test_rate_limiter_channel():
+    limiter = RateLimiter({'channel': {'rate': 1, 'per': 60}})
+    assert limiter.allow('user', 'someone.User.example.test', '#channel')
+    assert not limiter.allow('user', 'other.User.example.test', '#channel')
+    assert limiter.allow('user', 'other.User.example.test', None)
+
+
+def test_rate_limiter_command():
+    limiter = RateLimiter({'commands': {'help': {'user': {'rate': 1, 'per': 60}}}})
+    assert limiter.allow('help', 'someone.User.example.test')
+    assert not limiter.allow('help', 'someone.User.example.test')
+    assert limiter.allow('user', 'someone.User.example.test')
@@ -0,0 +1,46 @@
+import pickle
+
+from hermes.records import DisplayStats, Torrent, User, project
+from hermes.utils import view
+
+USER = {
+    'ID': 1,
+    'Username': 'someone',
+    'ClassName': 'Power User',
+    'Class': 3,
+    'SecondaryClasses': [30],
+    'Level': 200,
+    'Enabled': '1',
+    'DisableIRC': '0',
+    'IRCKey': 'key',
+    'DisplayStats': {'Uploaded': '1 GB', 'Downloaded': '1 MB', 'Ratio': '1024',
+                     'Buffer': '1 GB'},
+    'Avatar': 'https://example.com/avatar.png',
+    'Profile': 'x' * 1000,
+}
+
+
+def test_project_user():
+    user = project({'action': 'user', 'username': 'someone'}, view(USER))
+    assert isinstance(user, User)
+    assert user.Username == user['Username'] == 'someone'
+    assert user.SecondaryClasses + [user.Class] == [30, 3]
+    assert user.DisplayStats == DisplayStats('1 GB', '1 MB', '1024')
+    assert user.DisplayStats['Ratio'] == '1024'
+    assert 'DisplayStats' in user
+    assert 'UserPage' not in user and user.UserPage is None
+    assert not hasattr(user, 'Avatar')
+    assert len(pickle.dumps(user)) < len(pickle.dumps(USER)) / 4
+    assert pickle.loads(pickle.dumps(user)) == user
+
+
+def test_project_by_req():
+    torrent = project({'action': 'torrent', 'req': 'torrent', 'torrent_id': 1},
+                      {'Name': 'album', 'Format': 'FLAC'})
+    assert isinstance(torrent, Torrent)
+    assert (torrent.Name, torrent.Format, torrent.LogScore) == ('album', 'FLAC', None)
+
+
+def test_project_unknown():
+    response = {'a': 1}
+    assert project({'action': 'top10'}, response) is response
@@ -0,0 +1,47 @@
+import pickle
+
+from hermes.utils import DotView, ListView, view
+
+RESPONSE = {
+    'name': 'artist',
+    'tags': ['rock', 'pop'],
+    'torrentgroup': [
+        {'groupId': 1, 'torrent': [{'id': 10}, {'id': 11}]},
+        {'groupId': 2, 'torrent': []},
+    ],
+    'stats': {'numGroups': 2},
+}
+
+
+def test_dot_view():
+    artist = view(RESPONSE)
+    assert isinstance(artist, DotView)
+    assert artist.name == 'artist' == artist['name']
+    assert artist.missing is None
+    assert 'stats' in artist and 'missing' not in artist
+    assert artist.stats.numGroups == 2
+    assert artist.stats is artist.stats
+    assert artist.tags is RESPONSE['tags']
+    assert artist.tags + ['jazz'] == ['rock', 'pop', 'jazz']
+    assert dict(artist.stats) == {'numGroups': 2}
+
+
+def test_list_view():
+    groups = view(RESPONSE).torrentgroup
+    assert isinstance(groups, ListView)
+    assert len(groups) == 2
+    assert groups[0].torrent[1].id == 11
+    assert groups[-1] is groups[1]
+    assert [group.groupId for group in groups] == [1, 2]
+    assert groups[1:] == [{'groupId': 2, 'torrent': []}]
+
+
+def test_no_copy():
+    data = {'a': {'b': 1}}
+    assert view(data)['a']._data is data['a']
+
+
+def test_pickle():
+    artist = pickle.loads(pickle.dumps(view(RESPONSE)))
+    assert artist == view(RESPONSE)
+    assert artist.torrentgroup[0].torrent[0].id == 10
@@ -0,0 +1,46 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import irc.client
+
+from hermes.identity import IdentityMap
+from hermes.records import User
+from hermes.utils import view
+from hermes.warmup import CacheWarmer, default_channels
+
+CONFIG = {
+    'site': {'tld': 'example.test'},
+    'irc': {'channels': {'orpheus': {}, 'staff': {'min_level': 800}}},
+    'interview': {'main_channel': 'recruitment', 'channels': ['interview']},
+}
+
+
+def whoreply(host, nick):
+    return irc.client.Event('whoreply', 'server', 'hermes',
+                            ['#staff', 'user', host, 'server', nick, 'H', '0 name'])
+
+
+def test_default_channels():
+    assert default_channels(view(CONFIG)) == ['staff', 'recruitment', 'interview']
+
+
+def test_warm(api):
+    api.user = lambda username: User(1, username, 'Staff', 5, [], 800)
+    bot = MagicMock()
+    bot.config = view(CONFIG)
+    bot.identities = IdentityMap()
+    bot.api = api
+    warmer = CacheWarmer(bot, {'interval': 0})
+    bot.identities.add('known.Staff.example.test', User(2, 'known'), 'known')
+
+    for host, nick in [('someone.Staff.example.test', 'someone'),
+                       ('someone.Staff.example.test', 'someone_'),
+                       ('known.Staff.example.test', 'known'),
+                       ('some.other.host', 'other')]:
+        warmer._on_whoreply(None, whoreply(host, nick))
+    assert len(warmer.pending) == 2
+
+    asyncio.run(warmer._warm())
+    assert api.calls == [('someone', 'low')]
+    assert bot.identities.get('someone.staff.example.test').Level == 800
+    assert warmer.warmed == 1